@@ -0,0 +1,153 @@
+from helper import *
+import json
+import sys
+import time
+import random
+import tracemalloc
+
+# ------------------------------------------------------------------------------
+# Parameters
+# ------------------------------------------------------------------------------
+
+# matching engines: name, matching mode, vectorized
+engines = [("periodic", 0, False), ("periodic-np", 0, True),
+           ("volume", 1, False), ("mv", 2, False)]
+asset_names = ['g','t','f','a','b','c','d','e','h','i'] # up to 10 assets
+sizes = [1000, 10000, 100000, 1000000] # total orders per run
+asset_counts = [1, 3]
+seed = 0
+memory = True # run every case a second time to measure memory
+output = './statistics/benchmark.json'
+
+# order workloads, each one builds a list of orders
+def uniform(size, assets):
+    return [create_random_order(assets, 100, 100) for i in range(size)]
+
+def narrow_price(size, assets):
+    # most orders cross
+    return [create_random_order(assets, 10, 100) for i in range(size)]
+
+def large_volume(size, assets):
+    return [create_random_order(assets, 100, 10000) for i in range(size)]
+
+def no_mes(size, assets):
+    orders = uniform(size, assets)
+    for order in orders:
+        order.mes = 0
+    return orders
+
+def full_mes(size, assets):
+    # all or nothing orders
+    orders = uniform(size, assets)
+    for order in orders:
+        order.mes = order.volume
+    return orders
+
+def alternating_mes(size, assets):
+    # all or nothing bids, asks in volume order alternate between all or
+    # nothing and no mes, so the largest volume and the smallest mes of a
+    # range of asks come from different orders
+    orders = full_mes(size, assets)
+    for a in assets:
+        asks = [o for o in orders if o.type == 's' and o.asset == a]
+        asks.sort(key=lambda o: o.volume, reverse=True)
+        for j, order in enumerate(asks):
+            if j % 2:
+                order.mes = 0
+    return orders
+
+def clustered(size, assets):
+    return create_random_orders(size, assets, 100, 100, seed, price='clustered')
+
+def lognormal(size, assets):
+    return create_random_orders(size, assets, 100, 1000, seed, volume='lognormal')
+
+workloads = [uniform, narrow_price, large_volume, no_mes, full_mes, alternating_mes,
+             clustered, lognormal]
+
+# ------------------------------------------------------------------------------
+# Command line arguments
+# ------------------------------------------------------------------------------
+
+# optional: sizes, asset counts (comma-separated lists) and output file
+if len(sys.argv) >= 2:
+    sizes = [int(n) for n in sys.argv[1].split(',')]
+    if len(sys.argv) >= 3:
+        asset_counts = [int(n) for n in sys.argv[2].split(',')]
+        if len(sys.argv) == 4:
+            output = sys.argv[3]
+        elif len(sys.argv) > 4:
+            sys.exit("Error: Wrong number of arguments (optional: sizes, asset counts, output file).")
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+
+# match every asset of a book, returns the results of all assets
+def run(matching, vectorized, assets, bids, asks):
+    results = []
+    for a in assets:
+        results.append(match(matching, a, bids[a], asks[a], False, False, vectorized))
+    return results
+
+# fresh copy of the books, matching changes order volumes
+def copy_books(assets, book):
+    return {a: [o.copy() for o in book[a]] for a in assets}
+
+f = open(output, 'w')
+for size in sizes:
+    for count in asset_counts:
+        assets = asset_names[:count]
+        for workload in workloads:
+            # build the order books
+            random.seed(seed)
+            valid_bids = {a: [] for a in assets}
+            valid_asks = {a: [] for a in assets}
+            for i, order in enumerate(workload(size, assets)):
+                order.client = str(i)
+                if order.type == 'b':
+                    valid_bids[order.asset].append(order)
+                else:
+                    valid_asks[order.asset].append(order)
+
+            for name, matching, vectorized in engines:
+                # wall time
+                bids = copy_books(assets, valid_bids)
+                asks = copy_books(assets, valid_asks)
+                random.seed(seed)
+                start = time.perf_counter()
+                results = run(matching, vectorized, assets, bids, asks)
+                wall = time.perf_counter() - start
+                trades = sum(len(r[1]) for r in results)
+                results = None
+
+                result = {"engine": name, "matching": matching, "orders": size,
+                          "assets": count, "workload": workload.__name__,
+                          "seed": seed, "trades": trades, "wall_time": wall}
+
+                # peak memory and retained blocks, measured separately since
+                # tracing slows down the matching
+                if memory:
+                    bids = copy_books(assets, valid_bids)
+                    asks = copy_books(assets, valid_asks)
+                    random.seed(seed)
+                    tracemalloc.start()
+                    results = run(matching, vectorized, assets, bids, asks)
+                    result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                    # only blocks allocated during the run are traced, the
+                    # snapshot counts the ones still held by the results
+                    # (trades and copies)
+                    snapshot = tracemalloc.take_snapshot()
+                    result["retained_blocks"] = sum(s.count for s in snapshot.statistics('lineno'))
+                    snapshot = None
+                    tracemalloc.stop()
+                    results = None
+
+                print("{:12} orders {:8} assets {:2} {:15} trades {:8} time {:9.3f}s"
+                      .format(name, size, count, workload.__name__, trades, wall))
+                # one json object per line
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+f.close()
+
+print("Results written to {}.".format(output))
@@ -62,6 +62,13 @@ loops = 0
 verbose = True
 gas_verbose = True
 graph_verbose = False
+vectorized = False # use the numpy periodic auction
+binary = True # send orders in the compact binary format
+processes = None # worker processes used to verify orders (None: one per core)
+staging = True # prepare the order during the registration phase
+commit_gas = 200000 # gas limit of a staged commit transaction
+session = False # encrypt orders with a per-day session key instead of ECIES
+verify = True # verify the whole auction, otherwise only fetch my own trades
 
 # ------------------------------------------------------------------------------
 # Command line arguments
@@ -102,13 +109,92 @@ if verbose:
 
 # create a filter to be notified when we are in a new phase
 phase_filter = darkPool.events.startPhase.createFilter(fromBlock="latest")
-# create a filter to be notified when a matching is published
-match_filter = darkPool.events.logTrade.createFilter(fromBlock="latest")
-# create a filter to be notified when an order is published
-secret_filter = darkPool.events.secretRevealed.createFilter(fromBlock="latest")
+# create filters to be notified when a matching is published, when an order is
+# published and when a ciphertext is revealed (executed orders are decrypted
+# with the ciphertexts of these logs). Verification needs the logs of every
+# client, otherwise the node only sends the ones of this client
+if verify:
+    match_filters = [darkPool.events.logTrade.createFilter(fromBlock="latest")]
+    secret_filter = darkPool.events.secretRevealed.createFilter(fromBlock="latest")
+    reveal_filter = darkPool.events.commitmentRevealed.createFilter(fromBlock="latest")
+else:
+    match_filters = trade_filters(darkPool, addr)
+    secret_filter = client_filter(darkPool.events.secretRevealed, addr)
+    reveal_filter = client_filter(darkPool.events.commitmentRevealed, addr)
 # create a filter to be notified when a claim about a fraud is made
 fraud_filter = darkPool.events.fraudClaimed.createFilter(fromBlock="latest")
 
+# read the order file, written either as an order string or already in the
+# binary format by the web front-end, returns the order string and its bytes
+def read_order():
+    try:
+        # open file to read transaction
+        f=open(filename, 'rb')
+        order_file = f.read()
+        f.close()
+        os.remove(filename)
+    except:
+        # send empty transaction
+        order_file = b"None"
+
+    if order_file[:1] == bytes([order_version]):
+        # already in the binary format
+        order_bytes = order_file
+        status, order = decode_order(assets, addr, order_bytes)
+        if status == 0:
+            order_string = "{},{},{},{},{}".format(order.type, order.asset,
+                           order.price, order.volume, order.mes)
+        else:
+            order_string = "None"
+    else:
+        order_string = order_file.decode('utf-8', 'replace')
+        if binary:
+            order_bytes = encode_order_string(order_string, assets)
+        else:
+            # generate random 32 byte nonce
+            nonce = os.urandom(32)
+            # append nonce and encode order string
+            order_bytes = order_string.encode('utf-8') + nonce
+    return order_string, order_bytes
+
+# encrypt the order for the assigned public key, with a new session key
+# (one per trading day) or ECIES
+def encrypt_order(pk, order_bytes):
+    if session:
+        return session_encrypt(new_session(pk), order_bytes)
+    return encrypt(pk, order_bytes)
+
+# encrypt the order and build the commit transaction ahead of the trading
+# phase, the transaction is signed in advance if the node signs for us
+def stage_order(pk, order_bytes):
+    # encrypt order bytes
+    order_ciphertext = encrypt_order(pk, order_bytes)
+    # hash ciphertext
+    order_hash = hashlib.sha3_256(order_ciphertext).digest()
+    # commit_order reverts before the trading phase, so the gas can't be
+    # estimated and is set explicitly
+    tx = darkPool.functions.commit_order(order_hash).buildTransaction(
+         {'from': addr, 'gas': commit_gas, 'nonce': w3.eth.getTransactionCount(addr)})
+    try:
+        raw_tx = w3.eth.signTransaction(tx).raw
+    except:
+        raw_tx = None
+    return order_ciphertext, tx, raw_tx
+
+# stage the order as soon as it is available in the registration phase
+def stage(phase):
+    global staged, order_string
+    if staging and staged is None and phase == 0 and os.path.exists(filename):
+        pk = darkPool.functions.us_pk(addr).call()
+        if pk != b'':
+            order_string, order_bytes = read_order()
+            staged = stage_order(pk, order_bytes)
+            if verbose:
+                print("Order staged:", order_string)
+
+# verification workers are kept for the whole run
+pool = validation_pool(processes)
+
 while (loops != max_loops):
     loops += 1
     total_gas = 0
@@ -117,31 +203,28 @@ while (loops != max_loops):
         print("--------------------------------------------------------------------------------------------")
         print("Waiting for the next trading day. Please add new order (either through script or front-end).")
 
+    # wait for trading phase, staging the order in the meantime
+    staged = None
     phase = darkPool.functions.phase().call()
-    while phase != 1:
-        # wait for trading phase
-        event = phase_filter.get_new_entries()
-        while not event:
-            event = phase_filter.get_new_entries()
-            time.sleep(1)
-        # get phase and expiration from event
-        phase = event[0]['args']['currentState']
-        expiration = event[0]['args']['expirationTime']
-
-    try:
-        # open file to read transaction
-        f=open(filename, 'r')
-        order_string = f.read()
-        f.close()
-        os.remove(filename)
-    except:
-        # send empty transaction
-        order_string = "None"
+    args = wait_for_phase(phase_filter, 1, phase, stage)
+    if args is not None:
+        expiration = args['expirationTime']
+    else:
+        expiration = darkPool.functions.expiration().call()
+
+    if staged is not None:
+        # send the staged commitment right away
+        order_ciphertext, tx, raw_tx = staged
+        if raw_tx is not None:
+            tx_hash = w3.eth.sendRawTransaction(raw_tx)
+        else:
+            tx_hash = w3.eth.sendTransaction(tx)
 
     # get logs in case we connected while the previous trading day was taking place,
     # we don't care about those logs so just discard
-    discard = match_filter.get_new_entries()
+    discard = get_new_entries(match_filters)
     discard = secret_filter.get_new_entries()
+    discard = reveal_filter.get_new_entries()
 
     if verbose:
         print("At Trading phase. Current block: {}, Expiration: {}.".format(w3.eth.blockNumber, expiration))
@@ -151,26 +234,24 @@ while (loops != max_loops):
     if verbose:
         print("Matching Algorithm:", matchings[matching])
 
-    # get assigned public key from contract
-    pk = darkPool.functions.us_pk(addr).call()
-    if pk == b'':
-        sys.exit("Error: Not registered on the smart contract, contact operator to register.")
-    elif verbose:
-        print("My assigned public key is:", pk)
+    if staged is None:
+        order_string, order_bytes = read_order()
 
-    if verbose:
-        print("My order is:", order_string)
+        # get assigned public key from contract
+        pk = darkPool.functions.us_pk(addr).call()
+        if pk == b'':
+            sys.exit("Error: Not registered on the smart contract, contact operator to register.")
+        elif verbose:
+            print("My assigned public key is:", pk)
 
-    # generate random 32 byte nonce
-    nonce = os.urandom(32)
-    # append nonce and encode order string
-    order_bytes = order_string.encode('utf-8') + nonce
-    # encrypt order bytes
-    order_ciphertext = encrypt(pk, order_bytes)
-    # hash ciphertext
-    order_hash = hashlib.sha3_256(order_ciphertext).digest()
-    # send hash (commitment)
-    tx_hash = darkPool.functions.commit_order(order_hash).transact()
+        if verbose:
+            print("My order is:", order_string)
+        # encrypt order bytes
+        order_ciphertext = encrypt_order(pk, order_bytes)
+        # hash ciphertext
+        order_hash = hashlib.sha3_256(order_ciphertext).digest()
+        # send hash (commitment)
+        tx_hash = darkPool.functions.commit_order(order_hash).transact()
     # wait for transaction receipt
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
 
@@ -181,14 +262,7 @@ while (loops != max_loops):
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait for reveal phase
-    while phase != 2:
-        event = phase_filter.get_new_entries()
-        while not event:
-            event = phase_filter.get_new_entries()
-            time.sleep(1)
-        # get phase and expiration from event
-        phase = event[0]['args']['currentState']
-        expiration = event[0]['args']['expirationTime']
+    expiration = wait_for_phase(phase_filter, 2)['expirationTime']
 
     if verbose:
         print("At Reveal phase. Current block: {}, Expiration: {}.".format(w3.eth.blockNumber, expiration))
@@ -204,20 +278,13 @@ while (loops != max_loops):
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait for results phase
-    while phase != 4:
-        event = phase_filter.get_new_entries()
-        while not event:
-            event = phase_filter.get_new_entries()
-            time.sleep(1)
-        # get phase and expiration from event
-        phase = event[0]['args']['currentState']
-        expiration = event[0]['args']['expirationTime']
+    expiration = wait_for_phase(phase_filter, 4)['expirationTime']
 
     if verbose:
         print("At Results phase. Current block: {}, Expiration: {}.".format(w3.eth.blockNumber, expiration))
 
     # get new published matchings
-    matches = match_filter.get_new_entries()
+    matches = get_new_entries(match_filters)
     for m in matches:
         # get matching details
         buyer = m['args']["buyer"]
@@ -242,100 +309,104 @@ while (loops != max_loops):
     trades_received[0] = ('0x1', '0x2', 'g', 1, 1)
     '''
 
-    executed = secret_filter.get_new_entries()
-    # verification of matches
-    for order in executed:
-        # extract details
-        sender = order['args']['sender']
-        commitment = order['args']['commitment']
-        ciphertext = order['args']['ciphertext']
-        secret = order['args']['secret']
-
-        # check if my order was executed
-        if sender == addr:
+    if not verify:
+        # only my own trades were fetched, the auction isn't verified
+        for order in secret_filter.get_new_entries():
             matched = True
             if verbose:
                 print("My order was executed.")
-
-        # validate commitment
-        status, order = validate_commitment(assets, sender, commitment, ciphertext, secret, False)
-
-        if status != 0:
+        trades_received.clear()
+    else:
+        executed = secret_filter.get_new_entries()
+        # (commitment, ciphertext) revealed this trading day by sender
+        revealed = {e['args']['sender']: (e['args']['commitment'], e['args']['ciphertext'])
+                    for e in reveal_filter.get_new_entries()}
+        # verification of matches
+        reveals = []
+        for order in executed:
+            # extract details, the commitment and the ciphertext are joined
+            # from the reveal logs
+            sender = order['args']['sender']
+            commitment, ciphertext = revealed.get(sender, (b'', b''))
+            secret = order['args']['secret']
+            reveals.append((sender, commitment, ciphertext, secret))
+
+            # check if my order was executed
+            if sender == addr:
+                matched = True
+                if verbose:
+                    print("My order was executed.")
+
+        # validate commitments across the process pool, valid orders are added
+        # to the appropriate list
+        bids, asks, invalid = validate_batch(assets, reveals, pool, False)
+        if invalid:
             sys.exit("Error: Invalid order found. Auction verifiaction failed.")
-        else:
-            # order is valid
-            #if verbose:
-            #    print("Order is valid.")
-            # check type and add to appropriate list
-            if order.type == 's':
-                valid_asks[order.asset].append(order.copy())
-            elif order.type == 'b':
-                valid_bids[order.asset].append(order.copy())
-
-    # add my own order in valid if not executed
-    if not matched and order_string != "None":
-        l = order_string.split(",")
-        my_order = Order(addr, l[0], l[1], int(l[2]), int(l[3]), int(l[4]), '')
-        if my_order.type == 'b':
-            valid_bids[my_order.asset].append(my_order.copy())
-        elif my_order.type == 's':
-            valid_asks[my_order.asset].append(my_order.copy())
-
-    # for each asset, perform matching locally
-    for a in assets:
-        bids = valid_bids[a]
-        asks = valid_asks[a]
-
-        clearedPrice, clearedOrders = match(matching, a, bids, asks, verbose, graph_verbose)
-
-        for c in clearedOrders:
-            bAddr = c[0].client
-            sAddr = c[1].client
-            vol = c[2]
-            # in MV mode, each match has a different price
-            if matching == 2:
-                clearedPrice = c[3]
-            calculated_trade = (bAddr, sAddr, a, vol, clearedPrice)
-            # search for this trade in the received trades
-            found = False
-            for trade in trades_received:
-                # in Volume mode price is sourced from elswhere
-                # so just use the one in the matching
-                if matching == 1:
-                    calculated_trade = (bAddr, sAddr, a, vol, trade[4])
-                if calculated_trade == trade:
-                    found = True
-                    # remove this trade since it was found
-                    trades_received.remove(trade)
-                    break
-            if not found:
-                # claim fraud
-                tx_hash = darkPool.functions.claim_fraud().transact()
-                tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
-                sys.exit("Error: Invalid matching found. Auction verifiaction failed.")
-
-    # check if at the end there are additional matchings in the list
-    if trades_received:
-        # claim fraud
-        tx_hash = darkPool.functions.claim_fraud().transact()
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
-        sys.exit("Error: Unaccounted matchings found. Auction verifiaction failed.")
-    elif verbose:
-        print("Auction verification succesful. No fraud detected.")
+        for a in assets:
+            valid_bids[a].extend(bids[a])
+            valid_asks[a].extend(asks[a])
+
+        # add my own order in valid if not executed
+        if not matched and order_string != "None":
+            l = order_string.split(",")
+            my_order = Order(addr, l[0], l[1], int(l[2]), int(l[3]), int(l[4]), '')
+            if my_order.type == 'b':
+                valid_bids[my_order.asset].append(my_order.copy())
+            elif my_order.type == 's':
+                valid_asks[my_order.asset].append(my_order.copy())
+
+        # for each asset, perform matching locally
+        for a in assets:
+            bids = valid_bids[a]
+            asks = valid_asks[a]
+
+            clearedPrice, clearedOrders = match(matching, a, bids, asks, verbose,
+                                                graph_verbose, vectorized)
+
+            for c in clearedOrders:
+                bAddr = c[0].client
+                sAddr = c[1].client
+                vol = c[2]
+                # in MV mode, each match has a different price
+                if matching == 2:
+                    clearedPrice = c[3]
+                calculated_trade = (bAddr, sAddr, a, vol, clearedPrice)
+                # search for this trade in the received trades
+                found = False
+                for trade in trades_received:
+                    # in Volume mode price is sourced from elswhere
+                    # so just use the one in the matching
+                    if matching == 1:
+                        calculated_trade = (bAddr, sAddr, a, vol, trade[4])
+                    if calculated_trade == trade:
+                        found = True
+                        # remove this trade since it was found
+                        trades_received.remove(trade)
+                        break
+                if not found:
+                    # claim fraud
+                    tx_hash = darkPool.functions.claim_fraud().transact()
+                    tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+                    sys.exit("Error: Invalid matching found. Auction verifiaction failed.")
+
+        # check if at the end there are additional matchings in the list
+        if trades_received:
+            # claim fraud
+            tx_hash = darkPool.functions.claim_fraud().transact()
+            tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+            sys.exit("Error: Unaccounted matchings found. Auction verifiaction failed.")
+        elif verbose:
+            print("Auction verification succesful. No fraud detected.")
 
     if gas_verbose:
         print("Total gas used during this trading day:", total_gas)
 
     # wait for registration phase
-    while phase != 0:
-        event = phase_filter.get_new_entries()
-        while not event:
-            event = phase_filter.get_new_entries()
-            time.sleep(1)
-        # get phase and expiration from event
-        phase = event[0]['args']['currentState']
-        expiration = event[0]['args']['expirationTime']
+    expiration = wait_for_phase(phase_filter, 0)['expirationTime']
 
     fraud = fraud_filter.get_new_entries()
     for f in fraud:
         print("Warning: Fraud claimed by", f['args']['claimer'])
+
+if pool is not None:
+    pool.shutdown()
@@ -33,6 +33,9 @@ addr2name = {}
 matching = 1
 client_num = 10
 duration = 1
+seed = None # seed for the random orders, set it to reproduce a run
+binary = True # send orders in the compact binary format
+session = False # encrypt orders with a per-day session key instead of ECIES
 
 # ------------------------------------------------------------------------------
 # Setup
@@ -115,6 +118,9 @@ if gas_verbose:
 # for this demonstration we will call orders from different existing
 # ganache accounts from this script
 
+# generate all the random orders at once
+random_orders = create_random_orders(client_num, assets, 100, 100, seed)
+
 # the register clients send their commitments
 tx_hashes = []
 for i in range(1, client_num+1):
@@ -129,7 +135,7 @@ for i in range(1, client_num+1):
     # eg "s,t,100,1005,50,1234" represents a sell order for asset t with
     #    volume 100, price 10.5 each and minimum order execution size 50
     # order will be provided by the client, generate random for this test
-    order = create_random_order(assets, 100, 100)
+    order = random_orders[i-1]
     # generate random 32 byte nonce
     nonce = os.urandom(32)
     '''
@@ -151,12 +157,20 @@ for i in range(1, client_num+1):
     '''
     if verbose:
         print("Client {} send order: {}".format(i, order_string))
-    # append nonce and encode order string
-    order_bytes = order_string.encode('utf-8') + nonce
+    if binary:
+        # compact binary encoding
+        order_bytes = encode_order_string(order_string, assets)
+    else:
+        # append nonce and encode order string
+        order_bytes = order_string.encode('utf-8') + nonce
     # get assigned public key from contract
     pk = darkPool.functions.us_pk(addr).call()
     # encrypt order bytes
-    ciphertext = encrypt(pk, order_bytes)
+    if session:
+        # one session key for the trading day
+        ciphertext = session_encrypt(new_session(pk), order_bytes)
+    else:
+        ciphertext = encrypt(pk, order_bytes)
     ciphertexts[addr] = ciphertext
     # hash ciphertext
     hash = hashlib.sha3_256(ciphertext).digest()
@@ -187,12 +201,13 @@ if gas_verbose:
 '''
 
 # the operator waits until (at least) the expiration of the trading phase
-while w3.eth.blockNumber < expiration:
-    time.sleep(1)
+wait_for_block(w3, expiration)
 
 # operator initiates reveil phase
 tx_hash = darkPool.functions.reveal_phase(duration).transact()
 tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+# ciphertexts are revealed in the logs from this block on
+reveal_start = tx_receipt.blockNumber
 
 expiration = darkPool.functions.expiration().call()
 if verbose:
@@ -229,8 +244,7 @@ for i in range(len(tx_hashes)):
         print("Gas used:", tx_receipt.gasUsed)
 
 # the operator waits until (at least) the expiration of the reveal phase
-while w3.eth.blockNumber < expiration:
-    time.sleep(1)
+wait_for_block(w3, expiration)
 
 # operator initiates calculation phase
 tx_hash = darkPool.functions.calc_phase().transact()
@@ -250,12 +264,14 @@ for a in assets:
     valid_asks[a] = []
     valid_bids[a] = []
 
-# operator reads commitments and ciphertext for each client
+# operator reads commitments and ciphertext for all clients at once
+contract_orders = read_orders(darkPool, w3.eth.accounts[1:client_num+1],
+                              from_block=reveal_start)
 for i in range(1, client_num+1):
     # get client address from server memory
     addr = w3.eth.accounts[i]
-    # get order from contract
-    order = darkPool.functions.orders(addr).call()
+    # get order from bulk read
+    order = contract_orders[i-1]
     #print(order)
     commitment = order[0]
     ciphertext = order[1]
@@ -266,8 +282,9 @@ for i in range(1, client_num+1):
         if verbose:
             print("Client", i, "did not submit an order")
     else:
-        # validate commitment
-        status, order = validate_commitment(assets, addr, commitment, ciphertext, secret, True)
+        # validate commitment and derive the shared secret with a single ECDH
+        status, order, aes_key = validate_and_derive(assets, addr, commitment,
+                                                     ciphertext, secret, True)
 
         if status != 0:
             invalid_addr.append(addr)
@@ -277,8 +294,8 @@ for i in range(1, client_num+1):
             # order is valid
             if verbose:
                 print("Client's {} order: {}".format(i, order))
-            # calculate shared secret and append to order
-            order.secret = shared_secret(secret, ciphertext)
+            # append shared secret to order
+            order.secret = aes_key
             # check type and add to appropriate list
             orders[addr] = order.copy()
             if order.type == 's':
@@ -292,6 +309,9 @@ if verbose:
     #print(valid_asks)
     #print(valid_bids)
 
+# clients whose secret key was already sent, transactions are mined in the
+# order they are sent so later trades send the empty secret for them
+published = set()
 # for each asset, perform matching
 for a in assets:
     bids = valid_bids[a]
@@ -310,6 +330,12 @@ for a in assets:
         sName = addr2name[sAddr]
         vol = c[2]
         if matching == 2: clearedPrice = c[3]
+        # the contract keeps the first secret key it receives for a client
+        if bAddr in published:
+            bSK = empty_secret
+        if sAddr in published:
+            sSK = empty_secret
+        published.update((bAddr, sAddr))
 
         # operator publishes matched orders
         tx_hash = darkPool.functions.reveal_match(a, bAddr, bSK, bName,
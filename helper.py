@@ -2,12 +2,26 @@ from dataclasses import dataclass
 import json
 import random
 import sys
+import os
+import re
 from coincurve import PrivateKey, PublicKey
 import hashlib
 from ecies import decrypt
 from ecies.utils import decapsulate, hex2prv, aes_decrypt
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256, keccak
+from Crypto.Protocol.KDF import HKDF
 import matplotlib.pyplot as plt
+import numpy as np
+from array import array
 from operator import attrgetter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import struct
+import time
+import asyncio
+import heapq
+from bisect import bisect_left, bisect_right
 
 ### Order Dataclass ###
 @dataclass
@@ -24,8 +38,174 @@ class Order:
         return Order(self.client, self.type, self.asset, self.price,
                      self.volume, self.mes, self.secret)
 
+### Order Book ###
+# orders are kept in buckets by price level (prices are small integers),
+# iterating over the book walks the levels in priority order
+class OrderBook:
+    def __init__(self, orders=(), descending=False):
+        # bids are walked from the highest price, asks from the lowest
+        self.descending = descending
+        self.levels = {}
+        self.size = 0
+        for order in orders:
+            self.add(order)
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            self.levels[order.price] = [order]
+        else:
+            level.append(order)
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for price in sorted(self.levels, reverse=self.descending):
+            level = self.levels[price]
+            # inside a level orders are sorted by volume (des),
+            # equal volumes keep their arrival order
+            level.sort(key=attrgetter("volume"), reverse=True)
+            yield from level
+
+### Order Batch ###
+# struct-of-arrays storage for all the orders of a trading day, every field is
+# a typed array and an order is just an index into them
+# addresses are stored once per client and secrets are packed in one buffer
+class OrderBatch:
+    def __init__(self, assets):
+        self.assets = list(assets)
+        self.asset_ids = {a: i for i, a in enumerate(self.assets)}
+        self.clients = []
+        self.client_ids = {}
+        # index in clients
+        self.client = array('q')
+        # 0: bid, 1: ask
+        self.side = array('b')
+        # index in assets
+        self.asset = array('h')
+        self.price = array('q')
+        self.volume = array('q')
+        self.mes = array('q')
+        # secret i is secrets[secret_offset[i]:secret_offset[i+1]]
+        self.secrets = bytearray()
+        self.secret_offset = array('q', [0])
+
+    def __len__(self):
+        return len(self.price)
+
+    # add an order, returns its index
+    def add(self, order):
+        cid = self.client_ids.get(order.client)
+        if cid is None:
+            cid = len(self.clients)
+            self.client_ids[order.client] = cid
+            self.clients.append(order.client)
+        self.client.append(cid)
+        self.side.append(0 if order.type == 'b' else 1)
+        self.asset.append(self.asset_ids[order.asset])
+        self.price.append(order.price)
+        self.volume.append(order.volume)
+        self.mes.append(order.mes)
+        if order.secret:
+            self.secrets += order.secret
+        self.secret_offset.append(len(self.secrets))
+        return len(self) - 1
+
+    def client_of(self, i):
+        return self.clients[self.client[i]]
+
+    def secret_of(self, i):
+        return bytes(self.secrets[self.secret_offset[i]:self.secret_offset[i+1]])
+
+    # add many orders at once from numpy columns (side, asset ids, ...)
+    def add_columns(self, side, asset, price, volume, mes, client=''):
+        n = len(price)
+        cid = self.client_ids.get(client)
+        if cid is None:
+            cid = len(self.clients)
+            self.client_ids[client] = cid
+            self.clients.append(client)
+        self.client.extend(array('q', [cid])*n)
+        self.side.frombytes(np.asarray(side, dtype=np.int8).tobytes())
+        self.asset.frombytes(np.asarray(asset, dtype=np.int16).tobytes())
+        self.price.frombytes(np.asarray(price, dtype=np.int64).tobytes())
+        self.volume.frombytes(np.asarray(volume, dtype=np.int64).tobytes())
+        self.mes.frombytes(np.asarray(mes, dtype=np.int64).tobytes())
+        # no secrets
+        self.secret_offset.extend(array('q', [len(self.secrets)])*n)
+
+    # build the Order object for index i (only for printing and plotting)
+    def order(self, i):
+        return Order(self.client_of(i), 'b' if self.side[i] == 0 else 's',
+                     self.assets[self.asset[i]], self.price[i], self.volume[i],
+                     self.mes[i], self.secret_of(i))
+
+    # numpy copy of a column
+    def column(self, name):
+        return np.array(getattr(self, name))
+
+    # the book of one asset
+    def book(self, asset):
+        mask = self.column('asset') == self.asset_ids[asset]
+        side = self.column('side')
+        return AssetBook(asset, np.flatnonzero(mask & (side == 0)),
+                         np.flatnonzero(mask & (side == 1)), self.column('price'),
+                         self.column('volume'), self.column('mes'))
+
+    # the books of all assets, every column is copied once and the orders are
+    # grouped by (asset, side) with one stable sort, so they keep their batch
+    # order inside a book
+    def books(self):
+        key = self.column('asset').astype(np.int64)*2 + self.column('side')
+        idx = np.argsort(key, kind='stable')
+        bounds = np.searchsorted(key[idx], np.arange(2*len(self.assets) + 1))
+        price = self.column('price')
+        volume = self.column('volume')
+        mes = self.column('mes')
+        books = {}
+        for k, a in enumerate(self.assets):
+            books[a] = AssetBook(a, idx[bounds[2*k]:bounds[2*k+1]],
+                                 idx[bounds[2*k+1]:bounds[2*k+2]], price, volume, mes)
+        return books
+
+# the orders of one asset in an OrderBatch: the batch indices of its bids and
+# asks and their price, volume and mes, which is all that is needed to match
+# the asset (in a worker process) without the rest of the batch
+class AssetBook:
+    def __init__(self, asset, bids, asks, price, volume, mes):
+        self.asset = asset
+        self.bids = bids
+        self.asks = asks
+        self.bid_price = price[bids]
+        self.bid_volume = volume[bids]
+        self.bid_mes = mes[bids]
+        self.ask_price = price[asks]
+        self.ask_volume = volume[asks]
+        self.ask_mes = mes[asks]
+
+# names of the external and public functions of the contract source that are
+# missing from the compiled abi, the contract has to be compiled again (truffle
+# compile) when it changed, an old build fails on the first missing function
+def missing_functions(contract_path):
+    truffleFile = json.load(open(contract_path))
+    build_path = os.path.dirname(os.path.dirname(os.path.abspath(contract_path)))
+    source_path = os.path.join(os.path.dirname(build_path), 'contracts',
+                               truffleFile['contractName'] + '.sol')
+    source = open(source_path).read()
+    names = re.findall(r'function\s+(\w+)\s*\([^)]*\)[^{;]*\b(?:external|public)\b', source)
+    names += re.findall(r'\b(?:public)\s+(\w+)\s*;', source)
+    compiled = {item.get('name') for item in truffleFile['abi']}
+    return [name for name in names if name not in compiled]
+
 # compile smart contract first (with truffle)
 def deploy_contract(w3, contract_path):
+    # check that the compiled file matches the contract
+    missing = missing_functions(contract_path)
+    if missing:
+        sys.exit("Error: {} is out of date ({} missing), run truffle compile"
+                 .format(contract_path, ', '.join(missing)))
     # open compiled file
     truffleFile = json.load(open(contract_path))
     # get abi and bytecode
@@ -41,6 +221,268 @@ def deploy_contract(w3, contract_path):
     print("Gas used:", tx_receipt.gasUsed)
     return tx_receipt.contractAddress
 
+### Phase Waiting ###
+
+# wait until the block number reaches block, new blocks are watched through a
+# block filter (or the block number if the node has no filters). The polling
+# interval starts at min_interval after every new block and doubles up to
+# max_interval, so a node that mines on demand is followed closely while a
+# node with a fixed block time sees about log2(max/min) polls per block and
+# then one every max_interval. A block is noticed at most max_interval late.
+# on_block is called for every new block while waiting
+def wait_for_block(w3, block, on_block=None, min_interval=0.01, max_interval=0.25):
+    try:
+        block_filter = w3.eth.filter('latest')
+    except Exception:
+        block_filter = None
+    current = w3.eth.blockNumber
+    delay = min_interval
+    try:
+        while current < block:
+            time.sleep(delay)
+            if block_filter is None or block_filter.get_new_entries():
+                new = w3.eth.blockNumber
+            else:
+                new = current
+            if new != current:
+                current = new
+                delay = min_interval
+                if on_block is not None:
+                    on_block()
+            else:
+                delay = min(delay * 2, max_interval)
+    finally:
+        if block_filter is not None:
+            w3.eth.uninstallFilter(block_filter.filter_id)
+    return current
+
+# wait for the startPhase event of phase and return its arguments (None if
+# current is already phase). on_poll is called with the latest known phase
+# before every poll of the filter
+def wait_for_phase(phase_filter, phase, current=None, on_poll=None,
+                   min_interval=0.01, max_interval=0.25):
+    args = None
+    delay = min_interval
+    while current != phase:
+        if on_poll is not None:
+            on_poll(current)
+        events = phase_filter.get_new_entries()
+        if not events:
+            time.sleep(delay)
+            delay = min(delay * 2, max_interval)
+            continue
+        delay = min_interval
+        for event in events:
+            args = event['args']
+            current = args['currentState']
+            if current == phase:
+                break
+    return args
+
+### Asynchronous Transactions ###
+
+# run blocking (web3) calls concurrently in threads, at most limit at a time,
+# returns their results in order
+async def run_all(funcs, limit=16):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit)
+    async def run(func):
+        async with semaphore:
+            return await loop.run_in_executor(None, func)
+    return await asyncio.gather(*[run(func) for func in funcs])
+
+# receipt of a transaction, None while it is pending
+def get_receipt(w3, tx_hash):
+    try:
+        return w3.eth.getTransactionReceipt(tx_hash)
+    except Exception:
+        # web3 raises TransactionNotFound for pending transactions
+        return None
+
+# wait for the receipts of many transactions at once, the pending ones are
+# polled together until all of them are mined, returns the receipts in order
+async def wait_for_receipts(w3, tx_hashes, min_interval=0.01, max_interval=0.25,
+                            timeout=120):
+    receipts = [None] * len(tx_hashes)
+    pending = list(range(len(tx_hashes)))
+    delay = min_interval
+    start = time.monotonic()
+    while pending:
+        found = await run_all([lambda h=tx_hashes[i]: get_receipt(w3, h) for i in pending])
+        for i, receipt in zip(pending, found):
+            receipts[i] = receipt
+        if all(receipt is not None for receipt in found):
+            break
+        pending = [i for i in pending if receipts[i] is None]
+        if time.monotonic() - start > timeout:
+            raise TimeoutError("{} transactions not mined after {} seconds".format(len(pending), timeout))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_interval)
+    return receipts
+
+# send contract function calls concurrently and wait for all receipts. If
+# ordered, the calls are sent one after the other (still without waiting for
+# receipts), so the node numbers them in that order and mines them in order
+async def send_all_async(w3, calls, transaction=None, ordered=False):
+    if ordered:
+        loop = asyncio.get_running_loop()
+        tx_hashes = []
+        for c in calls:
+            tx_hashes.append(await loop.run_in_executor(None, c.transact, transaction))
+    else:
+        tx_hashes = await run_all([lambda c=c: c.transact(transaction) for c in calls])
+    return await wait_for_receipts(w3, tx_hashes)
+
+# send contract function calls and return their receipts in order, either
+# concurrently or one after the other (waiting for the receipts at the end)
+def send_all(w3, calls, asynchronous=True, transaction=None):
+    if asynchronous:
+        return asyncio.run(send_all_async(w3, calls, transaction))
+    tx_hashes = [c.transact(transaction) for c in calls]
+    return [w3.eth.waitForTransactionReceipt(tx_hash) for tx_hash in tx_hashes]
+
+# order read from the contract as a tuple, the commitment and the secret are
+# fixed size (bytes32) and read as zero bytes when not set, they are returned
+# as empty bytes
+def order_fields(order):
+    return tuple(b'' if isinstance(field, bytes) and len(field) == 32
+                 and not any(field) else field for field in order)
+
+# replace the reveal flags of orders by the ciphertexts from the logs, the
+# logs are only read if some order is revealed
+def with_ciphertexts(contract, addresses, orders, from_block=0):
+    if not any(order[1] is True for order in orders):
+        return [(commitment, b'', sk) for commitment, revealed, sk in orders]
+    ciphertexts = revealed_ciphertexts(contract, from_block)
+    return [(commitment, ciphertexts.get((addr, commitment), b'') if revealed else b'', sk)
+            for addr, (commitment, revealed, sk) in zip(addresses, orders)]
+
+# ciphertexts revealed since from_block by (sender, commitment), read from the
+# commitmentRevealed logs
+def revealed_ciphertexts(contract, from_block=0):
+    logs = contract.events.commitmentRevealed.getLogs(fromBlock=from_block)
+    return {(e['args']['sender'], e['args']['commitment']): e['args']['ciphertext']
+            for e in logs}
+
+# read the orders (commitment, ciphertext, secret) of many clients with the
+# get_orders view, in chunks of chunk addresses. The contract only stores a
+# reveal flag and publishes the ciphertexts in its logs, these are read from
+# from_block (the start of the reveal phase)
+def read_orders(contract, addresses, chunk=200, from_block=0):
+    addresses = list(addresses)
+    orders = []
+    for i in range(0, len(addresses), chunk):
+        orders += [order_fields(order) for order in
+                   contract.functions.get_orders(addresses[i:i+chunk]).call()]
+    return with_ciphertexts(contract, addresses, orders, from_block)
+
+# secret key sent for a client whose key is already on the contract
+empty_secret = bytes(32)
+
+# trades with the secret keys of clients that appear again in a later trade
+# replaced by the empty secret, the contract stores the first secret it
+# receives for a client
+def without_repeated_secrets(trades):
+    seen = set()
+    result = []
+    for trade in trades:
+        trade = list(trade)
+        # buyer and seller with their secret keys
+        for c, sk in ((1, 2), (4, 5)):
+            if trade[c] in seen:
+                trade[sk] = empty_secret
+            else:
+                seen.add(trade[c])
+        result.append(tuple(trade))
+    return result
+
+# contract calls that publish the trades of an asset (asset, buyer, skB, nameB,
+# seller, skS, nameS, amount, price). If batched, trades are packed into
+# reveal_matches transactions that fit in the block gas limit: every trade is
+# assumed to need at most trade_gas and a chunk whose gas estimate is still
+# too high is split in half. Otherwise there is one reveal_match call per
+# trade. A secret key is only sent with the first trade of its client, so the
+# calls have to be sent in order (see send_all_async) and fail if an earlier
+# one did. Chunks are estimated with all their keys, the keys left out are
+# only on the contract once the earlier calls are mined
+def reveal_match_calls(w3, contract, trades, batched=True, trade_gas=160000, fill=0.9):
+    if not batched:
+        return [contract.functions.reveal_match(*trade)
+                for trade in without_repeated_secrets(trades)]
+    limit = int(w3.eth.getBlock('latest').gasLimit * fill)
+    size = max(1, limit // trade_gas)
+    chunks = [trades[i:i+size] for i in range(0, len(trades), size)]
+    sizes = []
+    while chunks:
+        chunk = chunks.pop(0)
+        if len(chunk) > 1:
+            try:
+                fits = contract.functions.reveal_matches(chunk).estimateGas() <= limit
+            except Exception:
+                # the node refuses estimates above the block gas limit
+                fits = False
+            if not fits:
+                half = len(chunk) // 2
+                chunks[:0] = [chunk[:half], chunk[half:]]
+                continue
+        sizes.append(len(chunk))
+    trades = without_repeated_secrets(trades)
+    calls = []
+    start = 0
+    for n in sizes:
+        calls.append(contract.functions.reveal_matches(trades[start:start+n]))
+        start += n
+    return calls
+
+### Event Filters ###
+
+# logTrade events are indexed by buyer, seller and asset id, the other events
+# by the client's address, so the node filters the logs before sending them.
+# Topics at different positions can only be combined with and, the trades of a
+# client (as buyer or as seller) need one filter per side
+
+# topic of an asset in logTrade events, keccak256 hash of the asset name
+def asset_id(asset):
+    return keccak.new(digest_bits=256, data=asset.encode('utf-8')).digest()
+
+# filters for the trades of a client, as buyer and as seller
+def trade_filters(contract, addr, from_block='latest'):
+    return [contract.events.logTrade.createFilter(fromBlock=from_block,
+                                                  argument_filters={'buyerAddr': addr}),
+            contract.events.logTrade.createFilter(fromBlock=from_block,
+                                                  argument_filters={'sellerAddr': addr})]
+
+# filter for the trades of an asset
+def asset_filter(contract, asset, from_block='latest'):
+    return contract.events.logTrade.createFilter(fromBlock=from_block,
+                                                 argument_filters={'assetId': asset_id(asset)})
+
+# filter for the events of a client, event is one of the contract events
+# with a sender (commitmentRevealed, secretRevealed)
+def client_filter(event, addr, from_block='latest'):
+    return event.createFilter(fromBlock=from_block, argument_filters={'sender': addr})
+
+# logs in the order they were emitted
+def log_order(logs):
+    return sorted(logs, key=lambda e: (e['blockNumber'], e['logIndex']))
+
+# new entries of several filters, in the order they were emitted
+def get_new_entries(filters):
+    return log_order([e for f in filters for e in f.get_new_entries()])
+
+# trades of a client since from_block, a client never trades with itself so
+# buyer and seller logs don't overlap
+def client_trades(contract, addr, from_block=0):
+    return log_order(contract.events.logTrade.getLogs(argument_filters={'buyerAddr': addr},
+                                                      fromBlock=from_block) +
+                     contract.events.logTrade.getLogs(argument_filters={'sellerAddr': addr},
+                                                      fromBlock=from_block))
+
+# trades of an asset since from_block
+def asset_trades(contract, asset, from_block=0):
+    return contract.events.logTrade.getLogs(argument_filters={'assetId': asset_id(asset)},
+                                            fromBlock=from_block)
+
 # produce a random order
 def create_random_order(assets, p_lim=100, v_lim=100):
     type = random.choice(['b', 's'])
@@ -50,13 +492,68 @@ def create_random_order(assets, p_lim=100, v_lim=100):
     mes = random.choice(range(vol+1))
     return Order('', type, asset, price, vol, mes, '')
 
-def shared_secret(sk, ciphertext):
-    if isinstance(sk, str):
-        private_key = hex2prv(sk)
-    elif isinstance(sk, bytes):
-        private_key = PrivateKey(sk)
+# produce n random orders at once from a seeded numpy generator,
+# the same seed always gives the same orders
+# price: 'uniform' in [1,p_lim) or 'clustered' around the mid price
+# volume: 'uniform' in [1,v_lim) or 'lognormal' (heavy tailed)
+# mes is uniform in [0,vol]
+# returns a list of Orders, or an OrderBatch if columns is True
+def create_random_orders(n, assets, p_lim=100, v_lim=100, seed=None,
+                         price='uniform', volume='uniform', columns=False):
+    rng = np.random.default_rng(seed)
+    # 0: buy, 1: sell
+    side = rng.integers(0, 2, n)
+    asset = rng.integers(0, len(assets), n)
+    if price == 'uniform':
+        prices = rng.integers(1, p_lim, n)
+    elif price == 'clustered':
+        prices = rng.normal(p_lim/2, p_lim/20, n)
+        prices = np.clip(np.rint(prices), 1, p_lim-1).astype(np.int64)
     else:
-        raise TypeError("Invalid secret key type")
+        raise ValueError("Invalid price distribution")
+    if volume == 'uniform':
+        vols = rng.integers(1, v_lim, n)
+    elif volume == 'lognormal':
+        # median volume is v_lim/10
+        vols = rng.lognormal(np.log(v_lim/10), 1, n)
+        vols = np.maximum(np.rint(vols), 1).astype(np.int64)
+    else:
+        raise ValueError("Invalid volume distribution")
+    mes = rng.integers(0, vols+1)
+
+    if columns:
+        batch = OrderBatch(assets)
+        batch.add_columns(side, asset, prices, vols, mes)
+        return batch
+    types = np.array(['b', 's'])[side].tolist()
+    names = np.array(assets)[asset].tolist()
+    return [Order('', t, a, p, v, m, '') for t, a, p, v, m in
+            zip(types, names, prices.tolist(), vols.tolist(), mes.tolist())]
+
+# parsed private keys, so every client key is parsed only once
+private_keys = {}
+
+def load_private_key(sk):
+    if sk not in private_keys:
+        if isinstance(sk, str):
+            private_keys[sk] = hex2prv(sk)
+        elif isinstance(sk, bytes):
+            private_keys[sk] = PrivateKey(sk)
+        else:
+            raise TypeError("Invalid secret key type")
+    return private_keys[sk]
+
+# ciphertexts are either ECIES (uncompressed ephemeral public key, 0x04 first
+# byte) or session encrypted (compressed session public key, 0x02 or 0x03)
+def is_session_ciphertext(ciphertext):
+    return ciphertext[:1] in (b'\x02', b'\x03')
+
+def shared_secret(sk, ciphertext):
+    private_key = load_private_key(sk)
+
+    if is_session_ciphertext(ciphertext):
+        session_pk = ciphertext[0:33]
+        return session_key(session_pk, PublicKey(session_pk), private_key)
 
     pubkey = ciphertext[0:65]
     ephemeral_public_key = PublicKey(pubkey)
@@ -65,97 +562,260 @@ def shared_secret(sk, ciphertext):
     return aes_key
 
 def decrypt_shared_secret(aes_key, ciphertext):
+    if is_session_ciphertext(ciphertext):
+        return session_decrypt(aes_key, ciphertext)
     encrypted = ciphertext[65:]
     return aes_decrypt(aes_key, encrypted)
 
+# Session keys: a client creates one session key pair per trading day and
+# derives the aes key from it and its assigned public key, the operator
+# derives the same key from the session public key and the private key.
+# Ciphertexts carry the compressed session public key (33 bytes), a 12 byte
+# nonce and the tag instead of a 65 byte ephemeral key and a 16 byte iv.
+session_info = b'darkpool session key'
+
+# derive the aes key of a session (identified by the compressed session
+# public key) from the other party's public key and one's own private key
+def session_key(session_pk, public_key, private_key):
+    shared_point = public_key.multiply(private_key.secret)
+    master = session_pk + shared_point.format(True)
+    return HKDF(master, 32, b'', SHA256, context=session_info)
+
+# create a session for the assigned public key pk, returns the compressed
+# session public key and the aes key
+def new_session(pk):
+    session_sk = PrivateKey()
+    session_pk = session_sk.public_key.format(True)
+    return session_pk, session_key(session_pk, PublicKey(pk), session_sk)
+
+def session_encrypt(session, data):
+    session_pk, key = session
+    nonce = os.urandom(12)
+    aes_cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    encrypted, tag = aes_cipher.encrypt_and_digest(data)
+    return session_pk + nonce + tag + encrypted
+
+def session_decrypt(key, ciphertext):
+    nonce = ciphertext[33:45]
+    tag = ciphertext[45:61]
+    aes_cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    return aes_cipher.decrypt_and_verify(ciphertext[61:], tag)
+
 def validate_commitment(assets, address, commitment, ciphertext, secret, type):
+    status, order, aes_key = validate_and_derive(assets, address, commitment,
+                                                 ciphertext, secret, type)
+    return status, order
+
+# validate a commitment and also return the shared secret (aes key) of the
+# ciphertext, the operator derives it from the private key with a single ECDH
+# and uses it both to decrypt the order and to reveal it after a match
+def validate_and_derive(assets, address, commitment, ciphertext, secret, type):
+    aes_key = None
     if commitment == hashlib.sha3_256(ciphertext).digest():
         try:
             # based on which key I know, decrypt ciphertext to get order
             if type: # if private key is known -> operator
-                order_bytes = decrypt(secret, ciphertext)
+                aes_key = shared_secret(secret, ciphertext)
             else: # if shared secret is known -> everyone else
-                order_bytes = decrypt_shared_secret(secret, ciphertext)
+                aes_key = secret
+            order_bytes = decrypt_shared_secret(aes_key, ciphertext)
         except Exception as e:
             # status 1: commitment doesn't match ciphertext
             error = "Decryption error: " + str(e)
-            return -1, error
+            return -1, error, None
 
-        # DANGER WORKING WITH USER INPUT!!! NEED TO MAKE SAFE
-        try:
-            # strip nonce away
-            order_bytes = order_bytes[:-32]
-            # decode bytes into string
-            order_string = order_bytes.decode()
-
-            # check if the order is empty
-            if order_string == "None":
-                # status 1: order is empty, return it
-                return 1, order_string
-            else:
-                # split order into its parts
-                order_list = order_string.split(",")
-                order = Order()
-                # add client to order
-                order.client = address
-                # check type
-                if order_list[0] == 's' or order_list[0] == 'b':
-                    order.type = order_list[0]
-                else:
-                    raise Exception()
-                # check asset
-                if order_list[1] in assets:
-                    order.asset = order_list[1]
-                else:
-                    raise Exception()
-                # turn price into integer
-                order_list[2] = int(order_list[2])
-                # price must be non-negative
-                if order_list[2] < 0:
-                    raise Exception()
-                else:
-                    order.price = order_list[2]
-                # turn volume into integer
-                order_list[3] = int(order_list[3])
-                # volume must be at least 1
-                if order_list[3] < 1:
-                    raise Exception()
-                else:
-                    order.volume = order_list[3]
-                # turn mes into int
-                order_list[4] = int(order_list[4])
-                # mes must be an integer in [0,vol]
-                if order_list[4] > order.volume or order_list[4] < 0:
-                    raise Exception()
-                else:
-                    order.mes = order_list[4]
-                # all checks passed => mark order as valid
-                # status 0: order is valid, return it
-                return 0, order
-        except:
-            # status 2: order not according to specification
-            return -1, "Order not according to specification, therefore invalid."
+        status, order = parse_order(assets, address, order_bytes)
+        return status, order, aes_key
     else:
         # status 1: commitment doesn't match ciphertext
-        return -1, "Commitment doesn't match ciphertext, order invalid."
+        return -1, "Commitment doesn't match ciphertext, order invalid.", None
+
+# compact binary order: version, side (0: bid, 1: ask), asset id (index in the
+# list of assets), price, volume and mes as fixed-width big-endian integers,
+# the empty order is the version byte alone. No nonce is appended, the
+# ciphertext is already randomised by the ephemeral key and the aes iv
+order_version = 1
+order_format = struct.Struct('>BBBIII')
+# largest price, volume or mes of an order (uint32 in the binary format), the
+# order columns of a batch and the vectorized auction use 64 bit integers
+order_max = 2**32 - 1
+
+# encode an order (None for the empty order) into the binary format,
+# raises an exception if it can't be represented
+def encode_order(order, assets):
+    if order is None:
+        return bytes([order_version])
+    side = ['b', 's'].index(order.type)
+    return order_format.pack(order_version, side, assets.index(order.asset),
+                             order.price, order.volume, order.mes)
 
-def match(matching, asset, bids, asks, verbose, graph_verbose):
+# encode an order string into the binary format, a string that is not a valid
+# order is left as it is (followed by a nonce) so that the operator rejects it
+def encode_order_string(order_string, assets):
+    nonce = os.urandom(32)
+    status, order = parse_order(assets, '', order_string.encode('utf-8') + nonce)
+    try:
+        if status == 0:
+            return encode_order(order, assets)
+        elif status == 1:
+            return encode_order(None, assets)
+    except Exception:
+        pass
+    return order_string.encode('utf-8') + nonce
+
+# decode an order in the binary format
+def decode_order(assets, address, order_bytes):
+    if len(order_bytes) == 1:
+        # status 1: order is empty
+        return 1, "None"
+    if len(order_bytes) != order_format.size:
+        return -1, "Order not according to specification, therefore invalid."
+    version, side, asset, price, volume, mes = order_format.unpack(order_bytes)
+    # price is unsigned so it can't be negative, volume must be at least 1
+    # and mes must be in [0,vol]
+    if side > 1 or asset >= len(assets) or volume < 1 or mes > volume:
+        return -1, "Order not according to specification, therefore invalid."
+    # status 0: order is valid
+    return 0, Order(address, 'bs'[side], assets[asset], price, volume, mes, '')
+
+# parse decrypted order bytes, either in the binary format or an order string
+# followed by a 32 byte nonce (legacy format)
+def parse_order(assets, address, order_bytes):
+    if order_bytes[:1] == bytes([order_version]):
+        return decode_order(assets, address, order_bytes)
+    # DANGER WORKING WITH USER INPUT!!! NEED TO MAKE SAFE
+    try:
+        # strip nonce away
+        order_bytes = order_bytes[:-32]
+        # decode bytes into string
+        order_string = order_bytes.decode()
+
+        # check if the order is empty
+        if order_string == "None":
+            # status 1: order is empty, return it
+            return 1, order_string
+        else:
+            # split order into its parts
+            order_list = order_string.split(",")
+            order = Order()
+            # add client to order
+            order.client = address
+            # check type
+            if order_list[0] == 's' or order_list[0] == 'b':
+                order.type = order_list[0]
+            else:
+                raise Exception()
+            # check asset
+            if order_list[1] in assets:
+                order.asset = order_list[1]
+            else:
+                raise Exception()
+            # turn price into integer
+            order_list[2] = int(order_list[2])
+            # price must be non-negative and fit the binary format
+            if order_list[2] < 0 or order_list[2] > order_max:
+                raise Exception()
+            else:
+                order.price = order_list[2]
+            # turn volume into integer
+            order_list[3] = int(order_list[3])
+            # volume must be at least 1 and fit the binary format
+            if order_list[3] < 1 or order_list[3] > order_max:
+                raise Exception()
+            else:
+                order.volume = order_list[3]
+            # turn mes into int
+            order_list[4] = int(order_list[4])
+            # mes must be an integer in [0,vol]
+            if order_list[4] > order.volume or order_list[4] < 0:
+                raise Exception()
+            else:
+                order.mes = order_list[4]
+            # all checks passed => mark order as valid
+            # status 0: order is valid, return it
+            return 0, order
+    except:
+        # status 2: order not according to specification
+        return -1, "Order not according to specification, therefore invalid."
+
+# validate one revealed order: (address, commitment, ciphertext, key), the key
+# is the private key (type True, operator) or the shared secret (type False)
+def validate_reveal(assets, reveal, type=True):
+    address, commitment, ciphertext, secret = reveal
+    return validate_and_derive(assets, address, commitment, ciphertext, secret, type)
+
+# process pool for validating orders, None for a single process. Workers are
+# forked like in match_batch_assets_async and keep their private key cache, so
+# a script creates one pool for its whole run and passes it to iter_orders
+def validation_pool(processes=None):
+    if processes == 1:
+        return None
+    context = multiprocessing.get_context('fork')
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+# validate the revealed orders of a trading day, decryption is spread over the
+# pool, yields (status, order, aes_key) for every reveal in order
+def iter_orders(assets, reveals, pool=None, chunksize=64, type=True):
+    # cheap commitment checks first, only matching ciphertexts are decrypted
+    checked = [r for r in reveals if r[1] == hashlib.sha3_256(r[2]).digest()]
+    if pool is None or len(checked) <= chunksize:
+        results = (validate_reveal(assets, r, type) for r in checked)
+    else:
+        # map keeps the results in the order of the reveals
+        results = pool.map(validate_reveal, [assets]*len(checked), checked,
+                           [type]*len(checked), chunksize=chunksize)
+    i = 0
+    for r in reveals:
+        if i < len(checked) and r is checked[i]:
+            i += 1
+            yield next(results)
+        else:
+            # status 1: commitment doesn't match ciphertext
+            yield -1, "Commitment doesn't match ciphertext, order invalid.", None
+
+def validate_orders(assets, reveals, pool=None, chunksize=64, type=True):
+    return list(iter_orders(assets, reveals, pool, chunksize, type))
+
+# validate the revealed orders of a trading day and sort them into books as
+# they are validated, returns the valid bids and asks per asset and the
+# addresses of the invalid (or empty) orders, all in the order of the reveals
+def validate_batch(assets, reveals, pool=None, type=True):
+    valid_bids = {a: [] for a in assets}
+    valid_asks = {a: [] for a in assets}
+    invalid_addr = []
+    for reveal, (status, order, aes_key) in zip(reveals, iter_orders(assets, reveals, pool, type=type)):
+        if status == 0:
+            # append shared secret to order
+            order.secret = aes_key
+            if order.type == 'b':
+                valid_bids[order.asset].append(order)
+            else:
+                valid_asks[order.asset].append(order)
+        else:
+            invalid_addr.append(reveal[0])
+    return valid_bids, valid_asks, invalid_addr
+
+# vectorized: use the numpy implementation of the periodic auction
+def match(matching, asset, bids, asks, verbose, graph_verbose, vectorized=False):
     clearedPrice = -1
     clearedOrders = []
     if matching == 0:
-        # sort bids and asks
-        # bids are sorted by price (des) and then volume (des)
-        bids.sort(key=attrgetter("volume"), reverse=True)
-        bids.sort(key=attrgetter("price"), reverse=True)
-        # asks are sorted by price (asc) and then volume (des)
-        asks.sort(key=attrgetter("volume"), reverse=True)
-        asks.sort(key=attrgetter("price"))
+        if not vectorized or graph_verbose:
+            # bucket bids and asks by price level
+            # bids are traversed by price (des) and then volume (des)
+            bidBook = OrderBook(bids, descending=True)
+            # asks are traversed by price (asc) and then volume (des)
+            askBook = OrderBook(asks)
 
         # get supply and demand curves
         if graph_verbose:
-            plt = supply_demand_plot(bids, asks)
+            plt = supply_demand_plot(list(bidBook), list(askBook))
         # perform periodic auction matching
-        clearedOrders, clearedPrice = periodic_auction(bids, asks)
+        if vectorized:
+            # orders are sorted inside the vectorized auction
+            clearedOrders, clearedPrice = vector_auction(bids, asks)
+        else:
+            clearedOrders, clearedPrice = periodic_auction(bidBook, askBook)
         if verbose:
             # print results
             for c in clearedOrders:
@@ -206,41 +866,26 @@ def match(matching, asset, bids, asks, verbose, graph_verbose):
         if graph_verbose:
             plt = supply_demand_plot(bids, asks)
 
-        # split into volume 1 orders
-        singleB = []
-        for bid in bids:
-            for i in range(bid.volume):
-                singleB.append(bid.copy())
-                singleB[-1].volume = 1
-        singleA = []
-        for ask in asks:
-            for i in range(ask.volume):
-                singleA.append(ask.copy())
-                singleA[-1].volume = 1
-
-        # perform maximum volume matching
-        totalVol, clearedOrdersSingle = mv(singleB, singleA)
-
-        # recombine orders
+        # perform maximum volume matching on whole orders
+        totalVol, clearedRuns = mv_runs(bids, asks)
+
+        # combine consecutive runs between the same pair of orders,
+        # orders are reported as single units, as if they were split
         clearedOrders = []
-        if clearedOrdersSingle:
-            prevB = clearedOrdersSingle[0][0]
-            prevA = clearedOrdersSingle[0][1]
-            count = 1
-            for c in clearedOrdersSingle[1:]:
-                if c[0] == prevB and c[1] == prevA:
-                    count += 1
-                else:
-                    p = int((prevA.price + prevB.price)/2)
-                    clearedOrders.append((prevB, prevA, count, p))
-                    prevB = c[0]
-                    prevA = c[1]
-                    count = 1
-            p = int((prevA.price + prevB.price)/2)
-            clearedOrders.append((prevB, prevA, count, p))
-            if verbose:
-                for c in clearedOrders:
-                    print(c)
+        for b, a, count in clearedRuns:
+            b = b.copy()
+            b.volume = 1
+            a = a.copy()
+            a.volume = 1
+            if clearedOrders and clearedOrders[-1][0] == b and clearedOrders[-1][1] == a:
+                prevB, prevA, prevCount, p = clearedOrders[-1]
+                clearedOrders[-1] = (prevB, prevA, prevCount + count, p)
+            else:
+                p = int((a.price + b.price)/2)
+                clearedOrders.append((b, a, count, p))
+        if clearedOrders and verbose:
+            for c in clearedOrders:
+                print(c)
         # plot graph
         if graph_verbose:
             plt.suptitle("Asset: " + asset)
@@ -249,6 +894,140 @@ def match(matching, asset, bids, asks, verbose, graph_verbose):
     # return price (if applicable) and matched orders
     return clearedPrice, clearedOrders
 
+# match the orders of one asset, the trades refer to order indices in the batch
+# instead of order copies: (bid, ask, volume) or (bid, ask, volume, price) in
+# MV mode
+def match_book(matching, book):
+    clearedPrice = -1
+    clearedOrders = []
+    bids = book.bids
+    asks = book.asks
+
+    if matching == 0:
+        # orders are sorted inside the vectorized auction
+        b, a, bVol, aVol, vol, clearedPrice = periodic_auction_np(
+            book.bid_price, book.bid_volume, book.ask_price, book.ask_volume)
+        clearedOrders = list(zip(bids[b].tolist(), asks[a].tolist(), vol.tolist()))
+
+    elif matching == 1:
+        # bids and asks are sorted by volume (des)
+        bo = np.argsort(-book.bid_volume, kind='stable')
+        ao = np.argsort(-book.ask_volume, kind='stable')
+        trades = volume_matching_idx(book.bid_volume[bo].tolist(), book.bid_mes[bo].tolist(),
+                                     book.ask_volume[ao].tolist(), book.ask_mes[ao].tolist())
+        bids = bids[bo].tolist()
+        asks = asks[ao].tolist()
+        for i, j, bv, av, vol in trades:
+            clearedOrders.append((bids[i], asks[j], vol))
+        # find the clearing price from somewhere else (get random here)
+        if clearedOrders:
+            clearedPrice = random.choice(range(1,100))
+
+    elif matching == 2:
+        # bids and asks are sorted by price (asc) and then volume (des)
+        bo = np.lexsort((-book.bid_volume, book.bid_price))
+        ao = np.lexsort((-book.ask_volume, book.ask_price))
+        bidPrice = book.bid_price[bo].tolist()
+        askPrice = book.ask_price[ao].tolist()
+        totalVol, runs = mv_runs_idx(bidPrice, book.bid_volume[bo].tolist(),
+                                     askPrice, book.ask_volume[ao].tolist())
+        bids = bids[bo].tolist()
+        asks = asks[ao].tolist()
+        for i, j, count in runs:
+            p = int((askPrice[j] + bidPrice[i])/2)
+            clearedOrders.append((bids[i], asks[j], count, p))
+
+    # return price (if applicable) and matched orders
+    return clearedPrice, clearedOrders
+
+# plot the orders of a book in the order they are matched
+def book_plot(matching, batch, book):
+    if matching == 0:
+        # bids are sorted by price (des) and then volume (des)
+        # asks are sorted by price (asc) and then volume (des)
+        bids = book.bids[np.lexsort((-book.bid_volume, -book.bid_price))]
+        asks = book.asks[np.lexsort((-book.ask_volume, book.ask_price))]
+        plt = supply_demand_plot([batch.order(i) for i in bids],
+                                 [batch.order(i) for i in asks])
+        plt.title("Asset: " + book.asset)
+    elif matching == 1:
+        bids = book.bids[np.argsort(-book.bid_volume, kind='stable')]
+        asks = book.asks[np.argsort(-book.ask_volume, kind='stable')]
+        plt = volume_plot([batch.order(i) for i in bids],
+                          [batch.order(i) for i in asks])
+        plt.suptitle("Asset: " + book.asset)
+    else:
+        bids = book.bids[np.lexsort((-book.bid_volume, book.bid_price))]
+        asks = book.asks[np.lexsort((-book.ask_volume, book.ask_price))]
+        plt = supply_demand_plot([batch.order(i) for i in bids],
+                                 [batch.order(i) for i in asks])
+        plt.suptitle("Asset: " + book.asset)
+    return plt
+
+def print_batch_result(matching, batch, asset, result):
+    clearedPrice, clearedOrders = result
+    for c in clearedOrders:
+        print((batch.order(c[0]), batch.order(c[1])) + tuple(c[2:]))
+    if matching != 2:
+        print("For asset {}, the clearing price is {}.".format(asset,clearedPrice))
+
+# same as match for the orders of one asset in an OrderBatch, but the trades
+# refer to order indices in the batch instead of order copies (see match_book)
+def match_batch(matching, batch, asset, verbose, graph_verbose, book=None):
+    if book is None:
+        book = batch.book(asset)
+    result = match_book(matching, book)
+    if graph_verbose:
+        plt = book_plot(matching, batch, book)
+    if verbose:
+        # print results
+        print_batch_result(matching, batch, asset, result)
+    # plot graph
+    if graph_verbose:
+        plt.show()
+    return result
+
+# perform matching for every asset of an OrderBatch, the books of different
+# assets are independent so they are matched in parallel by a pool of
+# processes. on_result(asset, result) is awaited as soon as an asset is
+# matched, so that its results are handled (published) while the other
+# assets are still matching. Returns the on_result values per asset
+async def match_batch_assets_async(matching, batch, on_result, verbose,
+                                   graph_verbose, processes=None):
+    assets = batch.assets
+    # the batch is split once, a worker only receives the book of its asset
+    books = batch.books()
+    # graphs can only be shown from the main process
+    if graph_verbose or processes == 1 or len(assets) < 2:
+        tasks = []
+        for a in assets:
+            result = match_batch(matching, batch, a, verbose, graph_verbose, books[a])
+            tasks.append(asyncio.ensure_future(on_result(a, result)))
+            # let the handlers of the previous assets start
+            await asyncio.sleep(0)
+        return dict(zip(assets, await asyncio.gather(*tasks)))
+
+    loop = asyncio.get_running_loop()
+    # workers are forked, the scripts have no main guard so a spawned
+    # worker would run them again when importing the main module
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        async def run(a):
+            result = await loop.run_in_executor(pool, match_book, matching, books[a])
+            if verbose:
+                # the batch is only in the main process
+                print_batch_result(matching, batch, a, result)
+            return await on_result(a, result)
+        return dict(zip(assets, await asyncio.gather(*[run(a) for a in assets])))
+
+# match_batch_assets_async without a result handler
+# returns {asset: (clearedPrice, clearedOrders)} in the same order as the assets
+def match_batch_assets(matching, batch, verbose, graph_verbose, processes=None):
+    async def keep(asset, result):
+        return result
+    return asyncio.run(match_batch_assets_async(matching, batch, keep, verbose,
+                                                graph_verbose, processes))
+
 def supply_demand_plot(bids, asks, mes=False):
     # total volume up to current order
     volS = 0
@@ -291,59 +1070,41 @@ def supply_demand_plot(bids, asks, mes=False):
 
 def periodic_auction(bids, asks):
     cleared = []
-    remaining = True
+    # walk both sides with a cursor instead of popping from the front,
+    # bids and asks can be sorted lists or order books
+    bids = iter(bids)
+    asks = iter(asks)
+    best_bid = next(bids, None)
+    best_ask = next(asks, None)
 
-    if asks:
-        best_ask = asks[0]
-    else:
-        remaining = False
-    if bids:
-        best_bid = bids[0]
-    else:
-        remaining = False
     # sell price: will sell at this price and more,
     # buy price:  will buy at this price and less
     # therefore      sell price <= buy price
-    while remaining and best_ask.price <= best_bid.price:
+    while best_ask is not None and best_bid is not None \
+          and best_ask.price <= best_bid.price:
         # find smallest volume, delete that and remove that much from the other
         # ask has smaller volume
         if best_ask.volume < best_bid.volume:
             cleared.append((best_bid.copy(),best_ask.copy(),best_ask.volume))
-            asks.pop(0)
             best_bid.volume -= best_ask.volume
-            if asks:
-                best_ask = asks[0]
-            else:
-                remaining = False
+            best_ask = next(asks, None)
         # bid has smaller volume
         elif best_ask.volume > best_bid.volume:
             cleared.append((best_bid.copy(),best_ask.copy(),best_bid.volume))
-            bids.pop(0)
             best_ask.volume -= best_bid.volume
-            if bids:
-                best_bid = bids[0]
-            else:
-                remaining = False
+            best_bid = next(bids, None)
         # equal volume, delete both
         else:
             cleared.append((best_bid.copy(),best_ask.copy(),best_bid.volume))
-            asks.pop(0)
-            bids.pop(0)
-            if asks:
-                best_ask = asks[0]
-            else:
-                remaining = False
-            if bids:
-                best_bid = bids[0]
-            else:
-                remaining = False
+            best_ask = next(asks, None)
+            best_bid = next(bids, None)
     # find clearing price
     if cleared: # check if any orders are cleared
-        if bids and asks: # none empty => midprice
+        if best_bid is not None and best_ask is not None: # none empty => midprice
             cPrice = round((cleared[-1][0].price + cleared[-1][1].price)/2)
-        elif bids: # asks empty => bids price
+        elif best_bid is not None: # asks empty => bids price
             cPrice = cleared[-1][0].price
-        elif asks: # bids empty => asks price
+        elif best_ask is not None: # bids empty => asks price
             cPrice = cleared[-1][1].price
         else: # both empty => midprice
             cPrice = round((cleared[-1][0].price + cleared[-1][1].price)/2)
@@ -352,6 +1113,81 @@ def periodic_auction(bids, asks):
 
     return cleared, cPrice
 
+# vectorized periodic auction on price/volume arrays, prices and volumes are at
+# most order_max so the cumulative volumes of up to 2**31 orders fit in int64
+# returns the cleared trades as arrays of bid index, ask index, remaining bid
+# volume, remaining ask volume and traded volume, plus the clearing price
+def periodic_auction_np(bidPrice, bidVol, askPrice, askVol):
+    bidPrice = np.asarray(bidPrice, dtype=np.int64)
+    bidVol = np.asarray(bidVol, dtype=np.int64)
+    askPrice = np.asarray(askPrice, dtype=np.int64)
+    askVol = np.asarray(askVol, dtype=np.int64)
+    empty = np.zeros(0, dtype=np.int64)
+    if len(bidPrice) == 0 or len(askPrice) == 0:
+        return empty, empty, empty, empty, empty, -1
+
+    # bids are sorted by price (des) and then volume (des)
+    # asks are sorted by price (asc) and then volume (des)
+    # lexsort is stable, so ties keep their original order
+    bOrd = np.lexsort((-bidVol, -bidPrice))
+    aOrd = np.lexsort((-askVol, askPrice))
+    bP = bidPrice[bOrd]
+    aP = askPrice[aOrd]
+    # cumulative demand and supply curves
+    demand = np.cumsum(bidVol[bOrd])
+    supply = np.cumsum(askVol[aOrd])
+    total = min(demand[-1], supply[-1])
+
+    # a new trade starts every time one of the curves steps,
+    # both curves are already sorted so a stable sort just merges them
+    starts = np.concatenate(([0], demand, supply))
+    starts.sort(kind='stable')
+    starts = starts[np.append(True, starts[1:] != starts[:-1])]
+    starts = starts[starts < total]
+    # bid and ask that are at the front of the queue for each trade
+    b = np.searchsorted(demand, starts, side='right')
+    a = np.searchsorted(supply, starts, side='right')
+    # sell price <= buy price, the spread only grows along the curves
+    # so the crossing point is found with a binary search
+    k = np.searchsorted(aP[a] - bP[b], 0, side='right')
+    ends = np.append(starts[1:], total)
+    b, a, starts, ends = b[:k], a[:k], starts[:k], ends[:k]
+
+    # find clearing price
+    if k == 0:
+        return empty, empty, empty, empty, empty, -1
+    bLast = int(bP[b[-1]])
+    aLast = int(aP[a[-1]])
+    bidsLeft = ends[-1] < demand[-1]
+    asksLeft = ends[-1] < supply[-1]
+    if bidsLeft and not asksLeft: # asks empty => bids price
+        cPrice = bLast
+    elif asksLeft and not bidsLeft: # bids empty => asks price
+        cPrice = aLast
+    else: # both or none empty => midprice
+        cPrice = round((bLast + aLast)/2)
+
+    return (bOrd[b], aOrd[a], demand[b] - starts, supply[a] - starts,
+            ends - starts, cPrice)
+
+# periodic auction on order lists using the vectorized implementation,
+# output is the same as periodic_auction
+def vector_auction(bids, asks):
+    b, a, bVol, aVol, vol, cPrice = periodic_auction_np(
+        [o.price for o in bids], [o.volume for o in bids],
+        [o.price for o in asks], [o.volume for o in asks])
+    cleared = []
+    for i, j, bv, av, v in zip(b.tolist(), a.tolist(), bVol.tolist(),
+                               aVol.tolist(), vol.tolist()):
+        # copies carry the volume left before the trade, like periodic_auction
+        bid = bids[i]
+        ask = asks[j]
+        cleared.append((Order(bid.client, bid.type, bid.asset, bid.price, bv,
+                              bid.mes, bid.secret),
+                        Order(ask.client, ask.type, ask.asset, ask.price, av,
+                              ask.mes, ask.secret), v))
+    return cleared, cPrice
+
 def volume_plot(bids, asks):
     if bids and asks:
         m = max(bids[0].volume, asks[0].volume)
@@ -408,69 +1244,335 @@ def volume_plot(bids, asks):
     fig.tight_layout()
     return plt
 
-def volume_matching(orBids, orAsks):
+# bids and asks are in priority order (volume des)
+# every bid is matched greedily with the first compatible ask in that order
+def volume_matching(bids, asks):
+    cleared = []
+    trades = volume_matching_idx([b.volume for b in bids], [b.mes for b in bids],
+                                 [a.volume for a in asks], [a.mes for a in asks])
+    for i, j, bv, av, vol in trades:
+        # copies carry the volume left before the trade
+        b = bids[i]
+        a = asks[j]
+        cleared.append((Order(b.client, b.type, b.asset, b.price, bv, b.mes, b.secret),
+                        Order(a.client, a.type, a.asset, a.price, av, a.mes, a.secret),
+                        vol))
+    return cleared
+
+# index of the asks of a volume matching, finds the leftmost ask with volume >=
+# need and mes <= bv in O(log^2 n). Asks that are not used up have volume >=
+# mes, so the search is split by the ask mes:
+# - mes <= need: the ask fits if need is in [mes, volume], asks are kept in a
+#   segment tree over the sorted needs of the bids, every node has a heap of
+#   the asks whose interval covers it. Volumes only shrink, an ask that stops
+#   covering a node is added to smaller nodes and dropped from the heap later
+# - mes > need: the volume is larger than need, the ask fits if mes <= bv,
+#   asks are kept in a segment tree over their mes order with the leftmost
+#   position of each node
+# vols and alive are shared with the matching, update is called after an ask
+# traded
+class AskIndex:
+    def __init__(self, needs, vols, mes, alive):
+        self.vols = vols
+        self.mes = mes
+        self.alive = alive
+        self.n = n = len(vols)
+        self.needs = needs
+        self.nsize = 1
+        while self.nsize < len(needs):
+            self.nsize *= 2
+        self.heaps = [None]*(2*self.nsize)
+        # an ask covers the needs[lo[j]:hi[j]+1]
+        self.lo = [bisect_left(needs, m) for m in mes]
+        self.hi = [bisect_right(needs, v) - 1 for v in vols]
+        # asks are added in order, so pushing never has to move them up a heap
+        for j in range(n):
+            if alive[j] and self.lo[j] <= self.hi[j]:
+                self.cover(j)
+        # nodes from the leaf of a need to the root, with the last need they cover
+        self.paths = {}
+
+        order = sorted(range(n), key=mes.__getitem__)
+        self.sorted_mes = [mes[j] for j in order]
+        self.msize = 1
+        while self.msize < n:
+            self.msize *= 2
+        self.first = first = [n]*(2*self.msize)
+        for r, j in enumerate(order):
+            if alive[j]:
+                first[self.msize+r] = j
+        for k in range(self.msize-1, 0, -1):
+            first[k] = min(first[2*k], first[2*k+1])
+        self.rank = [0]*n
+        for r, j in enumerate(order):
+            self.rank[j] = r
+
+    # add ask j to the nodes of its interval
+    def cover(self, j):
+        heaps = self.heaps
+        l = self.lo[j] + self.nsize
+        r = self.hi[j] + self.nsize + 1
+        while l < r:
+            if l & 1:
+                if heaps[l] is None:
+                    heaps[l] = []
+                heapq.heappush(heaps[l], j)
+                l += 1
+            if r & 1:
+                r -= 1
+                if heaps[r] is None:
+                    heaps[r] = []
+                heapq.heappush(heaps[r], j)
+            l //= 2
+            r //= 2
+
+    def path(self, need):
+        path = self.paths.get(need)
+        if path is None:
+            path = []
+            k = self.nsize + bisect_left(self.needs, need)
+            height = 0
+            while k:
+                path.append((k, ((k + 1) << height) - 1 - self.nsize))
+                k //= 2
+                height += 1
+            self.paths[need] = path
+        return path
+
+    # leftmost ask with volume >= need and mes <= bv, n if there is none
+    def find(self, need, bv):
+        alive = self.alive
+        hi = self.hi
+        heaps = self.heaps
+        first = self.first
+        # leftmost ask covering need
+        j = self.n
+        for k, top in self.path(need):
+            h = heaps[k]
+            if h:
+                # drop used asks and asks that no longer cover the node
+                while h and (not alive[h[0]] or hi[h[0]] < top):
+                    heapq.heappop(h)
+                if h and h[0] < j:
+                    j = h[0]
+        # leftmost ask with need < mes <= bv
+        l = self.msize + bisect_right(self.sorted_mes, need)
+        r = self.msize + bisect_right(self.sorted_mes, bv)
+        while l < r:
+            if l & 1:
+                if first[l] < j:
+                    j = first[l]
+                l += 1
+            if r & 1:
+                r -= 1
+                if first[r] < j:
+                    j = first[r]
+            l //= 2
+            r //= 2
+        return j
+
+    def update(self, j):
+        if not self.alive[j]:
+            first = self.first
+            k = self.msize + self.rank[j]
+            first[k] = self.n
+            k //= 2
+            while k and first[k] == j:
+                a = first[2*k]
+                b = first[2*k+1]
+                first[k] = a if a < b else b
+                k //= 2
+            return
+        r = bisect_right(self.needs, self.vols[j]) - 1
+        if r < self.hi[j]:
+            self.hi[j] = r
+            if self.lo[j] <= r:
+                self.cover(j)
+
+# volume matching on lists of volumes and mes values
+# asks are kept in a segment tree over their position, where every node holds
+# the largest remaining volume and the smallest mes of the asks below it, so
+# the first compatible ask for a bid is usually found without scanning the
+# book. The two bounds of a node can come from different asks, once a search
+# visits more than a few paths of nodes the matching switches to an AskIndex
+# built from the remaining asks, which is slower on ordinary books but never
+# degrades
+# returns the trades as (bid index, ask index, bid volume, ask volume, volume)
+def volume_matching_idx(bidVol, bidMes, askVol, askMes):
     cleared = []
-    bids = orBids.copy()
-    asks = orAsks.copy()
+    n = len(askVol)
+    if n == 0:
+        return cleared
+    size = 1
+    while size < n:
+        size *= 2
+    # asks that are used up keep volume 0 and an unreachable mes
+    noMes = sys.maxsize
+    maxVol = [0]*(2*size)
+    minMes = [noMes]*(2*size)
+    vols = list(askVol)
+    alive = [vols[j] > 0 and vols[j] >= askMes[j] for j in range(n)]
+    count = sum(alive)
+    for j in range(n):
+        if alive[j]:
+            maxVol[size+j] = vols[j]
+            minMes[size+j] = askMes[j]
+    for k in range(size-1, 0, -1):
+        maxVol[k] = max(maxVol[2*k], maxVol[2*k+1])
+        minMes[k] = min(minMes[2*k], minMes[2*k+1])
+    # nodes a search may visit before switching to the index
+    budget = 8 * size.bit_length()
+    index = None
 
-    for b in bids:
-        # remove used asks
-        asks[:] = [a for a in asks if a.volume >= a.mes]
+    for i in range(len(bidVol)):
         # early termination
-        if not asks:
+        if count == 0:
             break
-
-        for a in asks:
-            if b.volume < b.mes:
-                # bid consumed, go to next bid
+        bv = bidVol[i]
+        bm = bidMes[i]
+        # an ask must fill at least the bid mes (and at least 1)
+        need = max(bm, 1)
+        # bid is consumed once its volume drops below its mes
+        while bv >= need:
+            if index is None:
+                # leftmost ask with volume >= need and mes <= bv
+                j = n
+                visits = 0
+                stack = [1]
+                while stack:
+                    k = stack.pop()
+                    if maxVol[k] < need or minMes[k] > bv:
+                        # not compatible, skip the whole subtree
+                        continue
+                    if k >= size:
+                        j = k - size
+                        break
+                    visits += 1
+                    if visits > budget:
+                        index = AskIndex(sorted({max(m, 1) for m in bidMes[i:]}),
+                                         vols, askMes, alive)
+                        break
+                    stack.append(2*k+1)
+                    stack.append(2*k)
+            if index is not None:
+                j = index.find(need, bv)
+            if j == n:
+                # no compatible ask left, go to next bid
                 break
-            if b.mes > a.volume or a.mes > b.volume:
-                # not compatible, go to next ask
-                continue
             # can match current ask with current bid
-            vol = min(a.volume, b.volume)
-            cleared.append((b.copy(),a.copy(),vol))
-            b.volume -= vol
-            a.volume -= vol
+            av = vols[j]
+            vol = min(av, bv)
+            cleared.append((i, j, bv, av, vol))
+            bv -= vol
+            av -= vol
+            vols[j] = av
+            # remove used asks
+            if av == 0 or av < askMes[j]:
+                alive[j] = False
+                count -= 1
+            if index is not None:
+                index.update(j)
+                continue
+            k = size + j
+            if alive[j]:
+                maxVol[k] = av
+            else:
+                maxVol[k] = 0
+                minMes[k] = noMes
+            k //= 2
+            while k:
+                v = max(maxVol[2*k], maxVol[2*k+1])
+                m = min(minMes[2*k], minMes[2*k+1])
+                if v == maxVol[k] and m == minMes[k]:
+                    # nodes above are not affected
+                    break
+                maxVol[k] = v
+                minMes[k] = m
+                k //= 2
 
     return cleared
 
 ### Maximizing Matching Functions ###
 
-def poll(lst):
-    if lst:
-        return lst.pop(0)
-    else:
-        return False
-
 # bids and asks are ordered in ascending price
+# both are read once with a cursor, so any iterable of orders works
+# (lists, order books or generators) and the inputs are left untouched
 def find_max_vol(bids, asks):
+    return max_vol_runs(((b.price, b.volume) for b in bids),
+                        ((a.price, a.volume) for a in asks))
+
+# find_max_vol on iterables of (price, volume) pairs
+def max_vol_runs(bids, asks):
     qmin = 0
-    a = poll(asks)
-    if a:
-        b = poll(bids)
-        while b and b.price < a.price:
-            b = poll(bids)
+    bids = iter(bids)
+    asks = iter(asks)
+    a = next(asks, None)
+    if a is not None:
+        b = next(bids, None)
+        while b is not None and b[0] < a[0]:
+            b = next(bids, None)
         qd = 0
         q = 0
-        while b:
-            if a and a.price <= b.price:
-                q = q + a.volume
-                a = poll(asks)
+        while b is not None:
+            if a is not None and a[0] <= b[0]:
+                q = q + a[1]
+                a = next(asks, None)
             else:
-                q = q - b.volume
+                q = q - b[1]
                 qmin = min(qmin, q)
-                qd = qd + b.volume
-                b = poll(bids)
+                qd = qd + b[1]
+                b = next(bids, None)
         qmin = qmin + qd
     return qmin
 
 # bids and asks are ordered in ascending price
 def mv(bids, asks):
-    q = find_max_vol(bids.copy(), asks.copy())
+    q = find_max_vol(bids, asks)
     #print(q)
     m = []
     for i in range(q):
         r_pos = len(bids)-q+i
         m.append((bids[r_pos], asks[i]))
     return q, m
+
+# maximum volume matching without splitting orders into volume 1 units,
+# each order is treated as a run of volume units
+# bids and asks are ordered in ascending price
+# returns the total volume and the matched runs as (bid, ask, count)
+def mv_runs(bids, asks):
+    q, m = mv_runs_idx([b.price for b in bids], [b.volume for b in bids],
+                       [a.price for a in asks], [a.volume for a in asks])
+    return q, [(bids[i], asks[j], count) for i, j, count in m]
+
+# mv_runs on lists of prices and volumes
+# returns the total volume and the matched runs as (bid index, ask index, count)
+def mv_runs_idx(bidPrice, bidVol, askPrice, askVol):
+    # the running sums in find_max_vol give the same result for runs
+    q = max_vol_runs(zip(bidPrice, bidVol), zip(askPrice, askVol))
+    m = []
+    if q == 0:
+        return q, m
+    # the q highest bid units are paired with the q lowest ask units,
+    # skip the bid units that are left out
+    skip = sum(bidVol) - q
+    i = 0
+    while skip >= bidVol[i]:
+        skip -= bidVol[i]
+        i += 1
+    bLeft = bidVol[i] - skip
+    j = 0
+    aLeft = askVol[j]
+    left = q
+    while left > 0:
+        count = min(bLeft, aLeft, left)
+        m.append((i, j, count))
+        left -= count
+        bLeft -= count
+        aLeft -= count
+        if bLeft == 0 and left > 0:
+            i += 1
+            bLeft = bidVol[i]
+        if aLeft == 0 and left > 0:
+            j += 1
+            aLeft = askVol[j]
+    return q, m
@@ -0,0 +1,261 @@
+from helper import *
+import random
+from operator import attrgetter
+
+# ------------------------------------------------------------------------------
+# Reference matching (original list based algorithms)
+# ------------------------------------------------------------------------------
+
+def old_periodic_auction(bids, asks):
+    cleared = []
+    remaining = True
+
+    if asks:
+        best_ask = asks[0]
+    else:
+        remaining = False
+    if bids:
+        best_bid = bids[0]
+    else:
+        remaining = False
+    while remaining and best_ask.price <= best_bid.price:
+        # ask has smaller volume
+        if best_ask.volume < best_bid.volume:
+            cleared.append((best_bid.copy(),best_ask.copy(),best_ask.volume))
+            asks.pop(0)
+            best_bid.volume -= best_ask.volume
+            if asks:
+                best_ask = asks[0]
+            else:
+                remaining = False
+        # bid has smaller volume
+        elif best_ask.volume > best_bid.volume:
+            cleared.append((best_bid.copy(),best_ask.copy(),best_bid.volume))
+            bids.pop(0)
+            best_ask.volume -= best_bid.volume
+            if bids:
+                best_bid = bids[0]
+            else:
+                remaining = False
+        # equal volume, delete both
+        else:
+            cleared.append((best_bid.copy(),best_ask.copy(),best_bid.volume))
+            asks.pop(0)
+            bids.pop(0)
+            if asks:
+                best_ask = asks[0]
+            else:
+                remaining = False
+            if bids:
+                best_bid = bids[0]
+            else:
+                remaining = False
+    # find clearing price
+    if cleared:
+        if bids and asks:
+            cPrice = round((cleared[-1][0].price + cleared[-1][1].price)/2)
+        elif bids:
+            cPrice = cleared[-1][0].price
+        elif asks:
+            cPrice = cleared[-1][1].price
+        else:
+            cPrice = round((cleared[-1][0].price + cleared[-1][1].price)/2)
+    else:
+        cPrice = -1
+
+    return cleared, cPrice
+
+def old_volume_matching(orBids, orAsks):
+    cleared = []
+    bids = orBids.copy()
+    asks = orAsks.copy()
+
+    for b in bids:
+        # remove used asks
+        asks[:] = [a for a in asks if a.volume >= a.mes]
+        # early termination
+        if not asks:
+            break
+
+        for a in asks:
+            if b.volume < b.mes:
+                # bid consumed, go to next bid
+                break
+            if b.mes > a.volume or a.mes > b.volume:
+                # not compatible, go to next ask
+                continue
+            # can match current ask with current bid
+            vol = min(a.volume, b.volume)
+            cleared.append((b.copy(),a.copy(),vol))
+            b.volume -= vol
+            a.volume -= vol
+
+    return cleared
+
+def poll(lst):
+    if lst:
+        return lst.pop(0)
+    else:
+        return False
+
+def old_find_max_vol(bids, asks):
+    qmin = 0
+    a = poll(asks)
+    if a:
+        b = poll(bids)
+        while b and b.price < a.price:
+            b = poll(bids)
+        qd = 0
+        q = 0
+        while b:
+            if a and a.price <= b.price:
+                q = q + a.volume
+                a = poll(asks)
+            else:
+                q = q - b.volume
+                qmin = min(qmin, q)
+                qd = qd + b.volume
+                b = poll(bids)
+        qmin = qmin + qd
+    return qmin
+
+def old_mv(bids, asks):
+    q = old_find_max_vol(bids.copy(), asks.copy())
+    m = []
+    for i in range(q):
+        r_pos = len(bids)-q+i
+        m.append((bids[r_pos], asks[i]))
+    return q, m
+
+# original match without printing and plotting, returns the same as match
+def old_match(matching, bids, asks):
+    clearedPrice = -1
+    clearedOrders = []
+    if matching == 0:
+        bids.sort(key=attrgetter("volume"), reverse=True)
+        bids.sort(key=attrgetter("price"), reverse=True)
+        asks.sort(key=attrgetter("volume"), reverse=True)
+        asks.sort(key=attrgetter("price"))
+        clearedOrders, clearedPrice = old_periodic_auction(bids, asks)
+
+    elif matching == 1:
+        bids.sort(key=attrgetter("volume"), reverse=True)
+        asks.sort(key=attrgetter("volume"), reverse=True)
+        clearedOrders = old_volume_matching(bids, asks)
+
+    elif matching == 2:
+        bids.sort(key=attrgetter("volume"), reverse=True)
+        bids.sort(key=attrgetter("price"))
+        asks.sort(key=attrgetter("volume"), reverse=True)
+        asks.sort(key=attrgetter("price"))
+        # split into volume 1 orders
+        singleB = []
+        for bid in bids:
+            for i in range(bid.volume):
+                singleB.append(bid.copy())
+                singleB[-1].volume = 1
+        singleA = []
+        for ask in asks:
+            for i in range(ask.volume):
+                singleA.append(ask.copy())
+                singleA[-1].volume = 1
+        totalVol, clearedOrdersSingle = old_mv(singleB, singleA)
+        # recombine orders
+        if clearedOrdersSingle:
+            prevB = clearedOrdersSingle[0][0]
+            prevA = clearedOrdersSingle[0][1]
+            count = 1
+            for c in clearedOrdersSingle[1:]:
+                if c[0] == prevB and c[1] == prevA:
+                    count += 1
+                else:
+                    p = int((prevA.price + prevB.price)/2)
+                    clearedOrders.append((prevB, prevA, count, p))
+                    prevB = c[0]
+                    prevA = c[1]
+                    count = 1
+            p = int((prevA.price + prevB.price)/2)
+            clearedOrders.append((prevB, prevA, count, p))
+
+    return clearedPrice, clearedOrders
+
+# ------------------------------------------------------------------------------
+# Order books
+# ------------------------------------------------------------------------------
+
+# (number of orders, price limit, volume limit), small price limits give many
+# orders at the same price level, volumes are kept small for the unit copies
+# of the reference MV matching
+books = [(0, 100, 20), (1, 100, 20), (2, 3, 5), (10, 3, 5), (10, 100, 20),
+         (50, 5, 10), (200, 10, 20), (200, 100, 20), (500, 20, 10)]
+seed = 0
+
+def create_book(n, p_lim, v_lim):
+    bids = []
+    asks = []
+    for i in range(n):
+        order = create_random_order(['a'], p_lim, v_lim)
+        order.client = str(i)
+        if order.type == 'b':
+            bids.append(order)
+        else:
+            asks.append(order)
+    return bids, asks
+
+def copy_orders(orders):
+    return [o.copy() for o in orders]
+
+# trades of match_batch as (buyer, seller, volume, ...) like the trades of match
+def batch_trades(batch, trades):
+    return [(batch.client_of(c[0]), batch.client_of(c[1])) + tuple(c[2:]) for c in trades]
+
+def client_trades(trades):
+    return [(c[0].client, c[1].client) + tuple(c[2:]) for c in trades]
+
+# ------------------------------------------------------------------------------
+# Equivalence Tests
+# ------------------------------------------------------------------------------
+
+test_num = 1
+random.seed(seed)
+for n, p_lim, v_lim in books:
+    bids, asks = create_book(n, p_lim, v_lim)
+    batch = OrderBatch(['a'])
+    for order in bids + asks:
+        batch.add(order)
+
+    # ----- Periodic auction: -----
+    expected = old_match(0, copy_orders(bids), copy_orders(asks))
+    result = match(0, 'a', copy_orders(bids), copy_orders(asks), False, False)
+    assert result == expected, "Test {} failed: Periodic auction differs from the original one.".format(test_num)
+    test_num += 1
+    result = match(0, 'a', copy_orders(bids), copy_orders(asks), False, False, True)
+    assert result == expected, "Test {} failed: Vectorized periodic auction differs from the original one.".format(test_num)
+    test_num += 1
+    price, trades = match_batch(0, batch, 'a', False, False)
+    assert (price, batch_trades(batch, trades)) == (expected[0], client_trades(expected[1])), "Test {} failed: Periodic auction on a batch differs from the original one.".format(test_num)
+    test_num += 1
+
+    # ----- Volume matching: -----
+    expected = old_match(1, copy_orders(bids), copy_orders(asks))[1]
+    # the original matching also reports zero volume trades between used up
+    # asks with mes 0 and the following bids, they don't trade anything and
+    # are left out by the indexed matching
+    expected = [c for c in expected if c[2] > 0]
+    result = match(1, 'a', copy_orders(bids), copy_orders(asks), False, False)[1]
+    assert result == expected, "Test {} failed: Volume matching differs from the original one.".format(test_num)
+    test_num += 1
+    trades = match_batch(1, batch, 'a', False, False)[1]
+    assert batch_trades(batch, trades) == client_trades(expected), "Test {} failed: Volume matching on a batch differs from the original one.".format(test_num)
+    test_num += 1
+
+    # ----- Maximum volume matching: -----
+    expected = old_match(2, copy_orders(bids), copy_orders(asks))
+    result = match(2, 'a', copy_orders(bids), copy_orders(asks), False, False)
+    assert result == expected, "Test {} failed: MV matching differs from the original one.".format(test_num)
+    test_num += 1
+    price, trades = match_batch(2, batch, 'a', False, False)
+    assert batch_trades(batch, trades) == client_trades(expected[1]), "Test {} failed: MV matching on a batch differs from the original one.".format(test_num)
+    test_num += 1
+
+print("All tests passed                ({:3d} tests)".format(test_num-1))
@@ -36,6 +36,10 @@ max_client_num = 1000
 client_start = 100
 client_step = 100
 duration = 1
+seed = None # seed for the random orders, set it to reproduce a run
+binary = True # send orders in the compact binary format
+session = False # encrypt orders with a per-day session key instead of ECIES
+processes = None # worker processes used to validate orders (None: one per core)
 
 # ------------------------------------------------------------------------------
 # Setup
@@ -122,6 +126,9 @@ if gas_verbose:
     print("Total gas used during initial registration:", total_gas)
 total_gas = 0
 
+# validation workers are kept for all the experiments
+pool = validation_pool(processes)
+
 # run multiple experiments varying the client number every time
 for client_num in range(client_start, max_client_num+1, client_step):
 
@@ -152,6 +159,11 @@ for client_num in range(client_start, max_client_num+1, client_step):
     # for this demonstration we will call orders from different existing
     # ganache accounts from this script
 
+    # generate all the random orders of the day at once,
+    # every day uses a different seed
+    day_seed = None if seed is None else seed + client_num
+    random_orders = create_random_orders(client_num, assets, 100, 100, day_seed)
+
     # the register clients send their commitments
     tx_hashes = []
     for i in range(1, client_num+1):
@@ -166,7 +178,7 @@ for client_num in range(client_start, max_client_num+1, client_step):
         # eg "s,t,100,1005,50,1234" represents a sell order for asset t with
         #    volume 100, price 10.5 each and minimum order execution size 50
         # order will be provided by the client, generate random for this test
-        order = create_random_order(assets, 100, 100)
+        order = random_orders[i-1]
         # generate random 32 byte nonce
         nonce = os.urandom(32)
         '''
@@ -188,12 +200,20 @@ for client_num in range(client_start, max_client_num+1, client_step):
         '''
         #if verbose:
         #    print("Client {} send order: {}".format(i, order_string))
-        # append nonce and encode order string
-        order_bytes = order_string.encode('utf-8') + nonce
+        if binary:
+            # compact binary encoding
+            order_bytes = encode_order_string(order_string, assets)
+        else:
+            # append nonce and encode order string
+            order_bytes = order_string.encode('utf-8') + nonce
         # get assigned public key from contract
         pk = darkPool.functions.us_pk(addr).call()
         # encrypt order bytes
-        ciphertext = encrypt(pk, order_bytes)
+        if session:
+            # one session key for the trading day
+            ciphertext = session_encrypt(new_session(pk), order_bytes)
+        else:
+            ciphertext = encrypt(pk, order_bytes)
         ciphertexts[addr] = ciphertext
         # hash ciphertext
         hash = hashlib.sha3_256(ciphertext).digest()
@@ -225,12 +245,13 @@ for client_num in range(client_start, max_client_num+1, client_step):
     '''
 
     # the operator waits until (at least) the expiration of the trading phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(10)
+    wait_for_block(w3, expiration)
 
     # operator initiates reveal phase
     tx_hash = darkPool.functions.reveal_phase(duration).transact()
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash, timeout=1200)
+    # ciphertexts are revealed in the logs from this block on
+    reveal_start = tx_receipt.blockNumber
     total_gas += tx_receipt.gasUsed
     interaction_count += 1
 
@@ -269,8 +290,7 @@ for client_num in range(client_start, max_client_num+1, client_step):
             print("Gas used:", tx_receipt.gasUsed)
 
     # the operator waits until (at least) the expiration of the reveal phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(10)
+    wait_for_block(w3, expiration)
 
     # operator initiates calculation phase
     tx_hash = darkPool.functions.calc_phase().transact()
@@ -283,57 +303,38 @@ for client_num in range(client_start, max_client_num+1, client_step):
     if gas_verbose:
         print("Gas used:", tx_receipt.gasUsed)
 
-    # initialise
-    invalid_addr = []
-    orders = {}
-    valid_asks = {}
-    valid_bids = {}
-    for a in assets:
-        valid_asks[a] = []
-        valid_bids[a] = []
-
-    # operator reads commitments and ciphertext for each client
+    # operator reads commitments and ciphertext for all clients at once
+    contract_orders = read_orders(darkPool, w3.eth.accounts[1:client_num+1],
+                                  from_block=reveal_start)
+    reveals = []
     for i in range(1, client_num+1):
         # get client address from server memory
         addr = w3.eth.accounts[i]
-        # get order from contract
-        order = darkPool.functions.orders(addr).call()
+        # get order from bulk read
+        order = contract_orders[i-1]
         #print(order)
         commitment = order[0]
         ciphertext = order[1]
-        # get keys from memory
-        secret = addr2keys[addr].secret
         # check if client submited an order
         if len(commitment) == 0:
             if verbose:
                 print("Client", i, "did not submit an order")
         else:
-            # validate commitment
-            status, order = validate_commitment(assets, addr, commitment, ciphertext, secret, True)
-
-            if status != 0:
-                invalid_addr.append(addr)
-                if verbose:
-                    print("Client", i, order)
-            else:
-                # order is valid
-                #if verbose:
-                #    print("Client's {} order: {}".format(i, order))
-                # calculate shared secret and append to order
-                order.secret = shared_secret(secret, ciphertext)
-                # check type and add to appropriate list
-                orders[addr] = order.copy()
-                if order.type == 's':
-                    valid_asks[order.asset].append(order.copy())
-                elif order.type == 'b':
-                    valid_bids[order.asset].append(order.copy())
+            # get keys from memory
+            secret = addr2keys[addr].secret
+            reveals.append((addr, commitment, ciphertext, secret))
+
+    # validate all orders across the process pool
+    valid_bids, valid_asks, invalid_addr = validate_batch(assets, reveals, pool)
 
     if verbose:
         print("Addresses that send an invalid order:", invalid_addr)
-        #print(orders)
         #print(valid_asks)
         #print(valid_bids)
 
+    # clients whose secret key was already sent, transactions are mined in the
+    # order they are sent so later trades send the empty secret for them
+    published = set()
     # for each asset, perform matching
     for a in assets:
         bids = valid_bids[a]
@@ -352,6 +353,12 @@ for client_num in range(client_start, max_client_num+1, client_step):
             sName = addr2name[sAddr]
             vol = c[2]
             if matching == 2: clearedPrice = c[3]
+            # the contract keeps the first secret key it receives for a client
+            if bAddr in published:
+                bSK = empty_secret
+            if sAddr in published:
+                sSK = empty_secret
+            published.update((bAddr, sAddr))
 
             # operator publishes matched orders
             tx_hash = darkPool.functions.reveal_match(a, bAddr, bSK, bName,
@@ -409,22 +416,6 @@ for client_num in range(client_start, max_client_num+1, client_step):
     if gas_verbose:
         print("Gas used:", tx_receipt.gasUsed)
 
-    # delete orders
-    tx_hashes = []
-    for i in range(1, client_num+1):
-        addr = w3.eth.accounts[i]
-        tx_hash = darkPool.functions.remove_order(addr).transact()
-        tx_hashes.append(tx_hash)
-    # wait for all transactions to go through
-    for i in range(len(tx_hashes)):
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i], timeout=1200)
-        total_gas += tx_receipt.gasUsed
-        interaction_count += 1
-        #if verbose:
-        #    print("Client {} order deleted from contract at block {}".format(i+1,tx_receipt["blockNumber"]))
-        if gas_verbose:
-            print("Gas used:", tx_receipt.gasUsed)
-
     if stats_verbose:
         print("End of trading day. At Block:", w3.eth.blockNumber)
         stats.write(str(w3.eth.blockNumber))
@@ -442,6 +433,8 @@ for client_num in range(client_start, max_client_num+1, client_step):
 
 # Close stats file
 stats.close()
+if pool is not None:
+    pool.shutdown()
 
 '''
 # delete all clients
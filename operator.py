@@ -52,12 +52,8 @@ loop_count = 0
 addr2keys = {}
 addr2name = {}
 invalid_addr = []
-orders = {}
-valid_asks = {}
-valid_bids = {}
-for a in assets:
-    valid_asks[a] = []
-    valid_bids[a] = []
+# valid orders of the current trading day
+batch = OrderBatch(assets)
 
 # specific parameters, should be set for particular usecase
 client_num = 3
@@ -69,6 +65,10 @@ total_gas = 0
 verbose = True
 gas_verbose = True
 graph_verbose = True
+processes = None # worker processes used for validation and matching (None: one per core)
+incremental = True # validate orders as they are revealed
+asynchronous = True # send transactions concurrently and track receipts in bulk
+batched = True # publish many matches per transaction with reveal_matches
 
 # ------------------------------------------------------------------------------
 # Command line arguments
@@ -91,8 +91,80 @@ else:
 # Contract function calls
 # ------------------------------------------------------------------------------
 
+# validation workers are kept for the whole run
+pool = validation_pool(processes)
 # create a filter to be notified when we are in a new phase
 phase_filter = darkPool.events.startPhase.createFilter(fromBlock="latest")
+# create a filter to be notified when an order is revealed
+reveal_filter = darkPool.events.commitmentRevealed.createFilter(fromBlock="latest")
+# addresses whose revealed order was already validated this trading day
+revealed = set()
+
+# add a validated order to the batch of valid orders
+def add_order(addr, status, order, aes_key):
+    i = addr2name[addr]
+    if status == 0:
+        # order is valid
+        if verbose:
+            print("Client's {} order: {}".format(i, order))
+        # append shared secret to order
+        order.secret = aes_key
+        # add to the batch of valid orders
+        batch.add(order)
+    elif status == 1:
+        # order is empty
+        if verbose:
+            print("Client's {} order is empty.".format(i))
+    else:
+        # invalid order
+        invalid_addr.append(addr)
+        if verbose:
+            print("Client", i, order)
+
+# validate (address, commitment, ciphertext) reveals across the process pool
+# and add them to the batch in the order they were revealed
+def add_orders(reveals):
+    # get keys from memory
+    reveals = [(addr, commitment, ciphertext, addr2keys[addr].secret)
+               for addr, commitment, ciphertext in reveals]
+    results = validate_orders(assets, reveals, pool)
+    for reveal, (status, order, aes_key) in zip(reveals, results):
+        add_order(reveal[0], status, order, aes_key)
+
+# validate the orders revealed since the last call
+def add_revealed():
+    reveals = []
+    for event in reveal_filter.get_new_entries():
+        addr = event['args']['sender']
+        if addr in addr2keys and addr not in revealed:
+            revealed.add(addr)
+            reveals.append((addr, event['args']['commitment'], event['args']['ciphertext']))
+    add_orders(reveals)
+
+# contract calls that publish the matched orders of an asset
+def reveal_calls(a, result):
+    clearedPrice, clearedOrders = result
+    trades = []
+    #print(clearedOrders)
+    for c in clearedOrders:
+        # trades refer to orders by their index in the batch
+        bAddr = batch.client_of(c[0])
+        bSK = batch.secret_of(c[0])
+        bName = addr2name[bAddr]
+        sAddr = batch.client_of(c[1])
+        sSK = batch.secret_of(c[1])
+        sName = addr2name[sAddr]
+        vol = c[2]
+        if matching == 2:
+            clearedPrice = c[3]
+        trades.append((a, bAddr, bSK, bName, sAddr, sSK, sName, vol, clearedPrice))
+    return reveal_match_calls(w3, darkPool, trades, batched)
+
+# publish the matched orders of an asset and wait for the receipts, the calls
+# of an asset are sent in order: clients rebuild the books from the logs in
+# that order and break price and volume ties by it, other assets overlap
+async def publish(a, result):
+    return await send_all_async(w3, reveal_calls(a, result), ordered=True)
 
 # read client addresses
 registered = []
@@ -108,7 +180,7 @@ f.close()
 
 if registration:
     # register some clients
-    tx_hashes = []
+    calls = []
     for i in range(client_num):
         # this address will be send to the operator by the client in the final
         # application, but for now we will just use one of the existing addresses
@@ -117,11 +189,10 @@ if registration:
         addr2keys[addr] = generate_key()
         pk = addr2keys[addr].public_key.format(True)
         # send the address and the corresonding public key to the contract
-        tx_hash = darkPool.functions.register_client(addr, pk).transact()
-        tx_hashes.append(tx_hash)
-    # wait for all transactions to go through
-    for i in range(len(tx_hashes)):
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i])
+        calls.append(darkPool.functions.register_client(addr, pk))
+    # send and wait for all transactions to go through
+    tx_receipts = send_all(w3, calls, asynchronous)
+    for i, tx_receipt in enumerate(tx_receipts):
         if verbose:
             print("Client", i, "registered with address:", registered[i])
         if gas_verbose:
@@ -156,12 +227,13 @@ while loop_count < max_loops:
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait until the expiration of the trading phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    wait_for_block(w3, expiration)
 
     # initiate reveal phase
     tx_hash = darkPool.functions.reveal_phase(duration).transact()
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+    # ciphertexts are revealed in the logs from this block on
+    reveal_start = tx_receipt.blockNumber
     event = phase_filter.get_new_entries()
     expiration = event[0]['args']['expirationTime']
     if verbose:
@@ -169,9 +241,9 @@ while loop_count < max_loops:
     if gas_verbose:
         total_gas += tx_receipt.gasUsed
         print("Gas used:", tx_receipt.gasUsed)
-    # wait until the expiration of the reveal phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    # wait until the expiration of the reveal phase,
+    # orders are validated while they are revealed
+    wait_for_block(w3, expiration, add_revealed if incremental else None)
 
     # initiate calculation phase
     tx_hash = darkPool.functions.calc_phase().transact()
@@ -183,84 +255,53 @@ while loop_count < max_loops:
         total_gas += tx_receipt.gasUsed
         print("Gas used:", tx_receipt.gasUsed)
 
-    # read commitments and ciphertext for each client
-    for i in range(client_num):
+    # validate the orders revealed in the last blocks of the reveal phase
+    if incremental:
+        add_revealed()
+
+    # read commitments and ciphertext for each client that did not reveal,
+    # all in bulk
+    unrevealed = [i for i in range(client_num) if registered[i] not in revealed]
+    contract_orders = read_orders(darkPool, [registered[i] for i in unrevealed],
+                                  from_block=reveal_start)
+    reveals = []
+    for i, order in zip(unrevealed, contract_orders):
         # get client address from server memory
         addr = registered[i]
-        # get order from contract
-        order = darkPool.functions.orders(addr).call()
         #print(order)
         commitment = order[0]
         ciphertext = order[1]
-        # get keys from memory
-        secret = addr2keys[addr].secret
 
         # check if client submited an order
         if len(commitment) == 0:
             if verbose:
                 print("Client", i, "did not submit an order.")
         else:
-            # validate commitment
-            status, order = validate_commitment(assets, addr, commitment, ciphertext, secret, True)
-
-            if status == 0:
-                # order is valid
-                if verbose:
-                    print("Client's {} order: {}".format(i, order))
-                # calculate shared secret and append to order
-                order.secret = shared_secret(secret, ciphertext)
-                # check type and add to appropriate list
-                orders[addr] = order.copy()
-                if order.type == 's':
-                    valid_asks[order.asset].append(order.copy())
-                elif order.type == 'b':
-                    valid_bids[order.asset].append(order.copy())
-            elif status == 1:
-                # order is empty
-                if verbose:
-                    print("Client's {} order is empty.".format(i))
-            else:
-                # invalid order
-                invalid_addr.append(addr)
-                if verbose:
-                    print("Client", i, order)
+            reveals.append((addr, commitment, ciphertext))
+    # validate them all at once
+    add_orders(reveals)
 
     if verbose:
         print("Addresses that send an invalid order:", invalid_addr)
-        #print("Orders:", orders)
-        #print("Valid asks:", valid_asks)
-        #print("Valid bids:", valid_bids)
-
-    # for each asset, perform matching
+        #print("Valid orders:", [batch.order(i) for i in range(len(batch))])
+
+    if asynchronous:
+        # publish the results of each asset as soon as it is matched
+        tx_receipts = asyncio.run(match_batch_assets_async(matching, batch, publish,
+                                  verbose, graph_verbose, processes))
+    else:
+        # perform matching for all assets in parallel
+        results = match_batch_assets(matching, batch, verbose, graph_verbose, processes)
+        # for each asset, publish the results
+        tx_receipts = {}
+        for a in assets:
+            tx_receipts[a] = send_all(w3, reveal_calls(a, results[a]), False)
+
+    # ---Mathing Done---
     for a in assets:
-        bids = valid_bids[a]
-        asks = valid_asks[a]
-
-        clearedPrice, clearedOrders = match(matching, a, bids, asks, verbose, graph_verbose)
-
-        # ---Mathing Done---
-        # publish matched orders
-        tx_hashes = []
-        #print(clearedOrders)
-        for c in clearedOrders:
-            bAddr = c[0].client
-            bSK = c[0].secret
-            bName = addr2name[bAddr]
-            sAddr = c[1].client
-            sSK = c[1].secret
-            sName = addr2name[sAddr]
-            vol = c[2]
-            if matching == 2:
-                clearedPrice = c[3]
-            # operator publishes matched orders
-            tx_hash = darkPool.functions.reveal_match(a, bAddr, bSK, bName,
-                                sAddr, sSK, sName, vol, clearedPrice).transact()
-            #tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
-            tx_hashes.append(tx_hash)
-        for tx_hash in tx_hashes:
-            tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+        for tx_receipt in tx_receipts[a]:
             if verbose:
-                print("Matching published.")
+                print("Matchings published.")
             if gas_verbose:
                 total_gas += tx_receipt.gasUsed
                 print("Gas used:", tx_receipt.gasUsed)
@@ -284,12 +325,13 @@ while loop_count < max_loops:
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait until the expiration of the results phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    wait_for_block(w3, expiration)
 
     # initiate registration phase
     tx_hash = darkPool.functions.reg_phase().transact()
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+    # the orders of the next trading day are logged from here on
+    day_start = tx_receipt.blockNumber
     event = phase_filter.get_new_entries()
     if verbose:
         print("At Registration phase. Current block: {}.".format(w3.eth.blockNumber))
@@ -297,7 +339,7 @@ while loop_count < max_loops:
         total_gas += tx_receipt.gasUsed
         print("Gas used:", tx_receipt.gasUsed)
 
-'''
+    '''
     # assign new keys to clients that made a trade
     tx_hashes = []
     for addr in matched_addr:
@@ -314,36 +356,18 @@ while loop_count < max_loops:
     # wait for all transactions to go through
     for i in range(len(tx_hashes)):
         tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i])
-'''
-
-    # reset contract
-    tx_hashes = []
-    for i in range(client_num):
-        addr = registered[i]
-        tx_hash = darkPool.functions.remove_order(addr).transact()
-        tx_hashes.append(tx_hash)
-    # wait for all transactions to go through
-    for i in range(len(tx_hashes)):
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i])
-        if verbose:
-            print("Client", i+1, "order deleted from contract.")
-        if gas_verbose:
-            total_gas += tx_receipt.gasUsed
-            print("Gas used:", tx_receipt.gasUsed)
+    '''
 
     # reset server memory
     invalid_addr = []
-    orders = {}
-    for a in assets:
-        valid_asks[a] = []
-        valid_bids[a] = []
-
-    # check that the contract variables were reset correctly
-    for i in range(client_num):
-        addr = registered[i]
-        assert darkPool.functions.orders(addr).call()[0] == b'', "Commitment not reset correctly."
-        assert darkPool.functions.orders(addr).call()[1] == b'', "Ciphertext not reset correctly."
-        assert darkPool.functions.orders(addr).call()[2] == b'', "Secret-key not reset correctly."
+    batch = OrderBatch(assets)
+    revealed.clear()
+
+    # check that the contract starts the next trading day with empty orders
+    for order in read_orders(darkPool, registered[:client_num], from_block=day_start):
+        assert order[0] == b'', "Commitment not reset correctly."
+        assert order[1] == b'', "Ciphertext not reset correctly."
+        assert order[2] == b'', "Secret-key not reset correctly."
     if verbose:
         print("Contract was reset correctly and is ready for reuse on the next trading day.")
     if gas_verbose:
@@ -352,14 +376,13 @@ while loop_count < max_loops:
 if clear:
     total_gas = 0
     # reset client accounts
-    tx_hashes = []
+    calls = []
     for i in range(client_num):
         addr = registered[i]
-        tx_hash = darkPool.functions.remove_client(addr).transact()
-        tx_hashes.append(tx_hash)
-    # wait for all transactions to go through
-    for i in range(len(tx_hashes)):
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i])
+        calls.append(darkPool.functions.remove_client(addr))
+    # send and wait for all transactions to go through
+    tx_receipts = send_all(w3, calls, asynchronous)
+    for i, tx_receipt in enumerate(tx_receipts):
         if verbose:
             print("Client", i+1, "deleted from contract.")
         if gas_verbose:
@@ -375,5 +398,7 @@ if clear:
     if verbose:
         print("All client accounts were deleted correctly.")
 
+if pool is not None:
+    pool.shutdown()
 if verbose:
     print("Server stoped, contract is still available when the server restarts.")
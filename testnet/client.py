@@ -95,13 +95,8 @@ while (True):
         print("--------------------------------------------------------------------------------------------")
         print("Waiting for the next trading day. Please add new order (either through script or front-end).")
 
-    phase = darkPool.functions.phase().call()
-    while phase != 1:
-        # wait for trading phase
-        time.sleep(1)
-        # get phase and expiration
-        phase = darkPool.functions.phase().call()
-        expiration = darkPool.functions.expiration().call()
+    # wait for trading phase
+    expiration = wait_for_phase(w3, darkPool, 1)
 
     # save block at the start of the trading day
     start = w3.eth.blockNumber
@@ -165,11 +160,7 @@ while (True):
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait for reveal phase
-    while phase != 2:
-        time.sleep(1)
-        # get phase and expiration
-        phase = darkPool.functions.phase().call()
-        expiration = darkPool.functions.expiration().call()
+    expiration = wait_for_phase(w3, darkPool, 2)
 
     if verbose:
         print("At Reveal phase. Current block: {}, Expiration: {}.".format(w3.eth.blockNumber, expiration))
@@ -195,11 +186,7 @@ while (True):
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait for results phase
-    while phase != 4:
-        time.sleep(1)
-        # get phase and expiration from event
-        phase = darkPool.functions.phase().call()
-        expiration = darkPool.functions.expiration().call()
+    expiration = wait_for_phase(w3, darkPool, 4)
 
     if verbose:
         print("At Results phase. Current block: {}, Expiration: {}.".format(w3.eth.blockNumber, expiration))
@@ -231,12 +218,14 @@ while (True):
     '''
 
     executed = darkPool.events.secretRevealed.getLogs(fromBlock=start)
+    # (commitment, ciphertext) revealed this trading day by sender
+    revealed = {e['args']['sender']: (e['args']['commitment'], e['args']['ciphertext'])
+                for e in darkPool.events.commitmentRevealed.getLogs(fromBlock=start)}
     # verification of mathes
     for order in executed:
         # extract details
         sender = order['args']['sender']
-        commitment = order['args']['commitment']
-        ciphertext = order['args']['ciphertext']
+        commitment, ciphertext = revealed.get(sender, (b'', b''))
         secret = order['args']['secret']
 
         # check if my order was executed
@@ -338,11 +327,7 @@ while (True):
         print("Total gas used during this trading day:", total_gas)
 
     # wait for registration phase
-    while phase != 0:
-        time.sleep(1)
-        # get phase and expiration from event
-        phase = darkPool.functions.phase().call()
-        expiration = darkPool.functions.expiration().call()
+    expiration = wait_for_phase(w3, darkPool, 0)
 
     fraud = darkPool.events.fraud_filter.getLogs(fromBlock=start)
     for f in fraud:
@@ -3,12 +3,19 @@ import json
 from web3 import Web3, HTTPProvider
 import sys
 import binascii
+from helper import missing_functions
 
 # path to parent directory
 parent_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # contract path
 contract_path = parent_path+'/truffle/build/contracts/darkPool.json'
 
+# check that the compiled file matches the contract
+missing = missing_functions(contract_path)
+if missing:
+    sys.exit("Error: {} is out of date ({} missing), run truffle compile"
+             .format(contract_path, ', '.join(missing)))
+
 # open compiled file and get abi & bytecode
 truffleFile = json.load(open(contract_path))
 abi = truffleFile['abi']
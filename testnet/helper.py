@@ -2,6 +2,9 @@ from dataclasses import dataclass
 import json
 import random
 import sys
+import os
+import re
+import time
 from coincurve import PrivateKey, PublicKey
 import hashlib
 from ecies import decrypt
@@ -24,8 +27,27 @@ class Order:
         return Order(self.client, self.type, self.asset, self.price,
                      self.volume, self.mes, self.secret)
 
+# names of the external and public functions of the contract source that are
+# missing from the compiled abi, the contract has to be compiled again (truffle
+# compile) when it changed, an old build fails on the first missing function
+def missing_functions(contract_path):
+    truffleFile = json.load(open(contract_path))
+    build_path = os.path.dirname(os.path.dirname(os.path.abspath(contract_path)))
+    source_path = os.path.join(os.path.dirname(build_path), 'contracts',
+                               truffleFile['contractName'] + '.sol')
+    source = open(source_path).read()
+    names = re.findall(r'function\s+(\w+)\s*\([^)]*\)[^{;]*\b(?:external|public)\b', source)
+    names += re.findall(r'\b(?:public)\s+(\w+)\s*;', source)
+    compiled = {item.get('name') for item in truffleFile['abi']}
+    return [name for name in names if name not in compiled]
+
 # compile smart contract first (with truffle)
 def deploy_contract(w3, contract_path):
+    # check that the compiled file matches the contract
+    missing = missing_functions(contract_path)
+    if missing:
+        sys.exit("Error: {} is out of date ({} missing), run truffle compile"
+                 .format(contract_path, ', '.join(missing)))
     # open compiled file
     truffleFile = json.load(open(contract_path))
     # get abi and bytecode
@@ -41,6 +63,81 @@ def deploy_contract(w3, contract_path):
     print("Gas used:", tx_receipt.gasUsed)
     return tx_receipt.contractAddress
 
+### Phase Waiting ###
+
+# wait until the block number reaches block. The polling interval starts at
+# min_interval after every new block and doubles up to max_interval, with 12
+# second blocks that is about 7 calls right after a block and then one every
+# max_interval. A block is noticed at most max_interval late.
+# on_block is called for every new block while waiting
+def wait_for_block(w3, block, on_block=None, min_interval=0.01, max_interval=1):
+    current = w3.eth.blockNumber
+    delay = min_interval
+    while current < block:
+        time.sleep(delay)
+        new = w3.eth.blockNumber
+        if new != current:
+            current = new
+            delay = min_interval
+            if on_block is not None:
+                on_block()
+        else:
+            delay = min(delay * 2, max_interval)
+    return current
+
+# wait until the contract reaches phase, the phase can only change in a new
+# block so it is read once per block. The block number is polled like in
+# wait_for_block. Returns the expiration of the phase
+def wait_for_phase(w3, contract, phase, min_interval=0.01, max_interval=1):
+    current = contract.functions.phase().call()
+    block = w3.eth.blockNumber
+    delay = min_interval
+    while current != phase:
+        time.sleep(delay)
+        new = w3.eth.blockNumber
+        if new != block:
+            block = new
+            delay = min_interval
+            current = contract.functions.phase().call()
+        else:
+            delay = min(delay * 2, max_interval)
+    return contract.functions.expiration().call()
+
+# order read from the contract as a tuple, the commitment and the secret are
+# fixed size (bytes32) and read as zero bytes when not set, they are returned
+# as empty bytes
+def order_fields(order):
+    return tuple(b'' if isinstance(field, bytes) and len(field) == 32
+                 and not any(field) else field for field in order)
+
+# replace the reveal flags of orders by the ciphertexts from the logs, the
+# logs are only read if some order is revealed
+def with_ciphertexts(contract, addresses, orders, from_block=0):
+    if not any(order[1] is True for order in orders):
+        return [(commitment, b'', sk) for commitment, revealed, sk in orders]
+    ciphertexts = revealed_ciphertexts(contract, from_block)
+    return [(commitment, ciphertexts.get((addr, commitment), b'') if revealed else b'', sk)
+            for addr, (commitment, revealed, sk) in zip(addresses, orders)]
+
+# ciphertexts revealed since from_block by (sender, commitment), read from the
+# commitmentRevealed logs
+def revealed_ciphertexts(contract, from_block=0):
+    logs = contract.events.commitmentRevealed.getLogs(fromBlock=from_block)
+    return {(e['args']['sender'], e['args']['commitment']): e['args']['ciphertext']
+            for e in logs}
+
+# read the orders (commitment, ciphertext, secret) of many clients with the
+# get_orders view, in chunks of chunk addresses. The contract only stores a
+# reveal flag and publishes the ciphertexts in its logs, these are read from
+# from_block (the start of the reveal phase)
+def read_orders(contract, addresses, chunk=200, from_block=0):
+    addresses = list(addresses)
+    orders = []
+    for i in range(0, len(addresses), chunk):
+        orders += [order_fields(order) for order in
+                   contract.functions.get_orders(addresses[i:i+chunk]).call()]
+    return with_ciphertexts(contract, addresses, orders, from_block)
+
 # produce a random order
 def create_random_order(assets, p_lim=100, v_lim=100):
     type = random.choice(['b', 's'])
@@ -183,8 +183,7 @@ while loop_count < max_loops:
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait until the expiration of the trading phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    wait_for_block(w3, expiration, max_interval=1)
 
     # initiate reveal phase
     # build transaction
@@ -199,6 +198,8 @@ while loop_count < max_loops:
     # send the transaction
     tx_hash = w3.eth.sendRawTransaction(sign_tx.rawTransaction)
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash, timeout=300)
+    # ciphertexts are revealed in the logs from this block on
+    reveal_start = tx_receipt.blockNumber
 
     expiration = darkPool.functions.expiration().call()
     if verbose:
@@ -207,8 +208,7 @@ while loop_count < max_loops:
         total_gas += tx_receipt.gasUsed
         print("Gas used:", tx_receipt.gasUsed)
     # wait until the expiration of the reveal phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    wait_for_block(w3, expiration, max_interval=1)
 
     # initiate calculation phase
     # build transaction
@@ -230,12 +230,13 @@ while loop_count < max_loops:
         total_gas += tx_receipt.gasUsed
         print("Gas used:", tx_receipt.gasUsed)
 
-    # read commitments and ciphertext for each client
+    # read commitments and ciphertext for all clients at once
+    contract_orders = read_orders(darkPool, registered[:client_num], from_block=reveal_start)
     for i in range(client_num):
         # get client address from server memory
         addr = registered[i]
-        # get order from contract
-        order = darkPool.functions.orders(addr).call()
+        # get order from bulk read
+        order = contract_orders[i]
         #print(order)
         commitment = order[0]
         ciphertext = order[1]
@@ -351,8 +352,7 @@ while loop_count < max_loops:
         print("Gas used:", tx_receipt.gasUsed)
 
     # wait until the expiration of the results phase
-    while w3.eth.blockNumber < expiration:
-        time.sleep(1)
+    wait_for_block(w3, expiration, max_interval=1)
 
     # initiate registration phase
     # build transaction
@@ -367,6 +367,8 @@ while loop_count < max_loops:
     # send the transaction
     tx_hash = w3.eth.sendRawTransaction(sign_tx.rawTransaction)
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash, timeout=300)
+    # the orders of the next trading day are logged from here on
+    day_start = tx_receipt.blockNumber
 
     if verbose:
         print("At Registration phase. Current block: {}.".format(w3.eth.blockNumber))
@@ -405,33 +407,6 @@ while loop_count < max_loops:
         tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i], timeout=300)
     '''
 
-    # reset contract
-    tx_hashes = []
-    nonce = w3.eth.getTransactionCount(myAddr)
-    for i in range(client_num):
-        addr = registered[i]
-
-        # build transaction
-        tx = darkPool.functions.remove_order(addr).buildTransaction({
-            'from': myAddr,
-            'nonce': nonce + i,
-            'gas': 6721975, # from truffle docs
-            'gasPrice': 100000000000 # from truffle docs
-        })
-        # sign transaction
-        sign_tx = w3.eth.account.signTransaction(tx, myKey)
-        # send the transaction
-        tx_hash = w3.eth.sendRawTransaction(sign_tx.rawTransaction)
-        tx_hashes.append(tx_hash)
-    # wait for all transactions to go through
-    for i in range(len(tx_hashes)):
-        tx_receipt = w3.eth.waitForTransactionReceipt(tx_hashes[i], timeout=300)
-        if verbose:
-            print("Client", i+1, "order deleted from contract.")
-        if gas_verbose:
-            total_gas += tx_receipt.gasUsed
-            print("Gas used:", tx_receipt.gasUsed)
-
     # reset server memory
     invalid_addr = []
     orders = {}
@@ -439,12 +414,11 @@ while loop_count < max_loops:
         valid_asks[a] = []
         valid_bids[a] = []
 
-    # check that the contract variables were reset correctly
-    for i in range(client_num):
-        addr = registered[i]
-        assert darkPool.functions.orders(addr).call()[0] == b'', "Commitment not reset correctly."
-        assert darkPool.functions.orders(addr).call()[1] == b'', "Ciphertext not reset correctly."
-        assert darkPool.functions.orders(addr).call()[2] == b'', "Secret-key not reset correctly."
+    # check that the contract starts the next trading day with empty orders
+    for order in read_orders(darkPool, registered[:client_num], from_block=day_start):
+        assert order[0] == b'', "Commitment not reset correctly."
+        assert order[1] == b'', "Ciphertext not reset correctly."
+        assert order[2] == b'', "Secret-key not reset correctly."
     if verbose:
         print("Contract was reset correctly and is ready for reuse on the next trading day.")
     if gas_verbose:
@@ -15,15 +15,39 @@ contract darkPool {
     enum Phase { Reg, Trd, Rev, Cal, Res }
     Phase public phase;
     address public operator; // adress of the dark pool operator
-    mapping(address => bytes) public us_pk; // user specific public key
-    // Stores details about each order
+    // user specific public key, compressed (33 bytes) and kept in two fixed
+    // slots, the prefix (0x02 or 0x03) is never zero for a registered client
+    struct PublicKey {
+        bytes1 prefix;
+        bytes32 x;
+    }
+    mapping(address => PublicKey) private pks;
+    // Stores details about each order, the commitment (SHA3-256 hash) and the
+    // secret key (32 bytes) fit in a single slot, zero means not set. The
+    // ciphertext is only published in the commitmentRevealed event, storage
+    // only records that the order was revealed
     struct Order {
-        bytes _commitment;
-        bytes _ciphertext;
-        bytes _sk;
+        bytes32 _commitment;
+        bool _revealed;
+        bytes32 _sk;
+    }
+    // Stores user orders of every trading day, so a new day starts with no
+    // orders and the previous ones don't have to be deleted
+    mapping(uint => mapping(address => Order)) private day_orders;
+    // current trading day
+    uint public day;
+    // Details of a match published by the operator
+    struct Trade {
+        string asset;
+        address buyer;
+        bytes32 skB;
+        string nameB;
+        address seller;
+        bytes32 skS;
+        string nameS;
+        uint amount;
+        uint price;
     }
-    // Stores user orders
-    mapping(address => Order) public orders;
     // 0: Periodic, 1: Volume, 2: MV
     uint public auctionMode;
     uint public expiration;
@@ -37,33 +61,34 @@ contract darkPool {
     // inform participants about "revealed" commitments only since
     // the rest are automatically rejected (invalid)
     event commitmentRevealed(
-        address sender,
-        bytes commitment,
+        address indexed sender,
+        bytes32 commitment,
         bytes ciphertext
     );
 
-    // reveal secret for a matched order
+    // reveal secret for a matched order, the commitment and the ciphertext
+    // are in the commitmentRevealed event of the sender
     event secretRevealed(
-      address sender,
-      bytes commitment,
-      bytes ciphertext,
-      bytes secret
+      address indexed sender,
+      bytes32 secret
     );
 
-    // log trades after they were matched
+    // log trades after they were matched, indexed by buyer, seller and asset
+    // (keccak256 hash of the asset name) so logs can be filtered by the node
     event logTrade(
         string buyer,
-        address buyerAddr,
+        address indexed buyerAddr,
         string seller,
-        address sellerAddr,
+        address indexed sellerAddr,
         string asset,
+        bytes32 indexed assetId,
         uint amount,
         uint price
     );
 
     // log when a registered client claims fraud
     event fraudClaimed(
-        address claimer
+        address indexed claimer
     );
 
     constructor() {
@@ -77,13 +102,22 @@ contract darkPool {
 
     // *** Operator functions ***
 
-    function register_client(address client_address, bytes memory pk) external {
+    function register_client(address client_address, bytes calldata pk) external {
         // only the operator can add new clients
         require(msg.sender == operator, "Only the operator can call this.");
         // check if we are at the registration phase
         require(phase == Phase.Reg, "This function is not callable at this phase.");
+        // check if it's a compressed public key
+        require(pk.length == 33 && (pk[0] == bytes1(0x02) || pk[0] == bytes1(0x03)), "Public key must be compressed.");
+        // read the x coordinate, the 32 bytes after the prefix (a bytes array
+        // in memory starts with its length)
+        bytes memory key = pk;
+        bytes32 x;
+        assembly {
+            x := mload(add(key, 33))
+        }
         // add client
-        us_pk[client_address] = pk;
+        pks[client_address] = PublicKey(pk[0], x);
     }
 
     // time: time for clients to send their hashed orders
@@ -136,37 +170,63 @@ contract darkPool {
         emit startPhase(Phase.Cal, 0);
     }
 
-    function reveal_match(string memory asset, address buyer, bytes memory skB, string memory nameB, address seller,
-                          bytes memory skS, string memory nameS, uint amount, uint price) external {
+    function reveal_match(string memory asset, address buyer, bytes32 skB, string memory nameB, address seller,
+                          bytes32 skS, string memory nameS, uint amount, uint price) external {
         // only the operator can reveal a match
         require(msg.sender == operator, "Only the operator can call this.");
          // check if we are at the calculation phase
         require(phase == Phase.Cal, "This function is not callable at this phase.");
-        // check that two different clients were provided
-        require(buyer != seller, "Buyer and Seller must not be the same.");
-        // check if buyer has provided all details
-        // check if commitment exists
-        require(orders[buyer]._commitment.length > 0, "No commitment provided by this buyer.");
-        // check if ciphertext exists
-        require(orders[buyer]._ciphertext.length > 0, "No ciphertext provided by this buyer.");
-        // check if seller has provided all details
-        // check if commitment exists
-        require(orders[seller]._commitment.length > 0, "No commitment provided by this buyer.");
-        // check if ciphertext exists
-        require(orders[seller]._ciphertext.length > 0, "No ciphertext provided by this buyer.");
-        // publish secret keys, allowing verification
-        // check if seller key was already published
-        if(orders[seller]._sk.length == 0) {
-            orders[seller]._sk = skS;
-            emit secretRevealed(seller, orders[seller]._commitment, orders[seller]._ciphertext, skS);
+        // publish the trade
+        _reveal_match(Trade(asset, buyer, skB, nameB, seller, skS, nameS, amount, price));
+    }
+
+    // reveal many matches in a single transaction
+    function reveal_matches(Trade[] calldata trades) external {
+        // only the operator can reveal a match
+        require(msg.sender == operator, "Only the operator can call this.");
+         // check if we are at the calculation phase
+        require(phase == Phase.Cal, "This function is not callable at this phase.");
+        // publish the trades in order
+        for (uint i = 0; i < trades.length; i++) {
+            _reveal_match(trades[i]);
         }
-        // check if buyer key was already published
-        if(orders[buyer]._sk.length == 0) {
-            orders[buyer]._sk = skB;
-            emit secretRevealed(buyer, orders[buyer]._commitment, orders[buyer]._ciphertext, skB);
+    }
+
+    function _reveal_match(Trade memory trade) internal {
+        // check that two different clients were provided
+        require(trade.buyer != trade.seller, "Buyer and Seller must not be the same.");
+        // the orders are only needed in this block, so they are off the stack
+        // when the trade event is emitted
+        {
+            Order storage buyerOrder = day_orders[day][trade.buyer];
+            Order storage sellerOrder = day_orders[day][trade.seller];
+            // check if buyer has provided all details
+            // check if commitment exists
+            require(buyerOrder._commitment != 0, "No commitment provided by this buyer.");
+            // check if ciphertext was revealed
+            require(buyerOrder._revealed, "No ciphertext provided by this buyer.");
+            // check if seller has provided all details
+            // check if commitment exists
+            require(sellerOrder._commitment != 0, "No commitment provided by this buyer.");
+            // check if ciphertext was revealed
+            require(sellerOrder._revealed, "No ciphertext provided by this buyer.");
+            // publish secret keys, allowing verification, the operator sends an
+            // empty secret key for a client whose key was already published
+            _reveal_secret(sellerOrder, trade.seller, trade.skS, "No secret key provided for this seller.");
+            _reveal_secret(buyerOrder, trade.buyer, trade.skB, "No secret key provided for this buyer.");
         }
         // emit trade event
-        emit logTrade(nameB, buyer, nameS, seller, asset, amount, price);
+        emit logTrade(trade.nameB, trade.buyer, trade.nameS, trade.seller, trade.asset,
+                      keccak256(bytes(trade.asset)), trade.amount, trade.price);
+    }
+
+    // publish the secret key of an order unless it was already published
+    function _reveal_secret(Order storage order, address client, bytes32 sk, string memory error) private {
+        if(order._sk == 0) {
+            require(sk != 0, error);
+            order._sk = sk;
+            emit secretRevealed(client, sk);
+        }
     }
 
     // time: time for clients to check if their order was executed, validate
@@ -193,15 +253,16 @@ contract darkPool {
         require(block.number >= expiration, "Please wait for the expiration of the previous phase.");
         // change to the registration phase
         phase = Phase.Reg;
+        // start a new trading day, orders of the previous day are left behind
+        day += 1;
         // emit event
         emit startPhase(Phase.Reg, 0);
     }
 
-    // *** IMPORTANT NOTE: ***
-    // At the end of a trading day, the operator MUST delete all orders or delete
-    // and reregister(in random order) every client that took part in the previous
-    // trading day, otherwise their previous order won't be deleted from the smart
-    // contract (this could lead to previous orders re-executing)
+    // *** NOTE: ***
+    // Orders are stored per trading day, so orders of the previous trading day
+    // can't re-execute and don't need to be deleted by the operator. An order
+    // of the current trading day can still be removed during registration.
 
     function remove_order(address client_address) external {
         // only the operator can delete orders
@@ -209,9 +270,9 @@ contract darkPool {
         // check if we are at the registration phase
         require(phase == Phase.Reg, "This function is not callable at this phase.");
         // check if client already assigned a public key
-        require(us_pk[client_address].length != 0, "Client not registered.");
+        require(pks[client_address].prefix != 0, "Client not registered.");
         // remove old order if any
-        delete orders[client_address];
+        delete day_orders[day][client_address];
     }
 
     function remove_client(address client_address) external {
@@ -220,68 +281,101 @@ contract darkPool {
         // check if we are at the registration phase
         require(phase == Phase.Reg, "This function is not callable at this phase.");
         // check if client already assigned a public key
-        require(us_pk[client_address].length != 0, "Client not registered.");
+        require(pks[client_address].prefix != 0, "Client not registered.");
         // remove old order if any
-        delete orders[client_address];
+        delete day_orders[day][client_address];
         // delete clients public key
-        delete us_pk[client_address];
+        delete pks[client_address];
+    }
+
+    // *** View functions ***
+
+    // compressed public key of a client, empty if the client isn't registered
+    function us_pk(address client) external view returns (bytes memory) {
+        PublicKey storage pk = pks[client];
+        if (pk.prefix == 0) {
+            return "";
+        }
+        return abi.encodePacked(pk.prefix, pk.x);
+    }
+
+    // order of a client on the current trading day
+    function orders(address client) external view returns (bytes32 _commitment, bool _revealed, bytes32 _sk) {
+        Order storage order = day_orders[day][client];
+        return (order._commitment, order._revealed, order._sk);
+    }
+
+    // read the orders of many clients in one call
+    function get_orders(address[] calldata clients) external view returns (Order[] memory) {
+        Order[] memory result = new Order[](clients.length);
+        for (uint i = 0; i < clients.length; i++) {
+            result[i] = day_orders[day][clients[i]];
+        }
+        return result;
     }
 
     // *** Client functions ***
 
-    function commit_order(bytes memory hashed_order) external {
+    function commit_order(bytes32 hashed_order) external {
          // check if we are at the trading phase
         require(phase == Phase.Trd, "This function is not callable at this phase.");
         // only a registered user can commit an order
-        require(us_pk[msg.sender].length > 0, "Transaction address does not correspond to a registered user.");
+        require(pks[msg.sender].prefix != 0, "Transaction address does not correspond to a registered user.");
         // check if commitment exists
-        require(orders[msg.sender]._commitment.length == 0, "Order already commited.");
+        require(day_orders[day][msg.sender]._commitment == 0, "Order already commited.");
+        // an empty commitment can't be told apart from no commitment
+        require(hashed_order != 0, "Commitment must not be empty.");
         // add commitment only (nonce and ciphertext set to default values)
-        orders[msg.sender]._commitment = hashed_order;
+        day_orders[day][msg.sender]._commitment = hashed_order;
     }
 
     function cancel_order() external {
          // check if we are at the trading phase
         require(phase == Phase.Trd, "This function is not callable at this phase.");
         // only a registered user can cancel an order
-        require(us_pk[msg.sender].length > 0, "Transaction address does not correspond to a registered user.");
+        require(pks[msg.sender].prefix != 0, "Transaction address does not correspond to a registered user.");
         // check if client has commited to an order
-        require(orders[msg.sender]._commitment.length > 0, "No commitment was made.");
+        require(day_orders[day][msg.sender]._commitment != 0, "No commitment was made.");
         // delete commitment
-        delete orders[msg.sender]._commitment;
+        delete day_orders[day][msg.sender]._commitment;
     }
 
-    function change_order(bytes memory hashed_order) external {
+    function change_order(bytes32 hashed_order) external {
          // check if we are at the trading phase
         require(phase == Phase.Trd, "This function is not callable at this phase.");
         // only a registered user can change an order
-        require(us_pk[msg.sender].length > 0, "Transaction address does not correspond to a registered user.");
+        require(pks[msg.sender].prefix != 0, "Transaction address does not correspond to a registered user.");
         // check if client has commited to an order
-        require(orders[msg.sender]._commitment.length > 0, "No commitment was made.");
+        require(day_orders[day][msg.sender]._commitment != 0, "No commitment was made.");
+        // an empty commitment can't be told apart from no commitment
+        require(hashed_order != 0, "Commitment must not be empty.");
         // change the commitment
-        orders[msg.sender]._commitment = hashed_order;
+        day_orders[day][msg.sender]._commitment = hashed_order;
     }
 
-    function reveal_order(bytes memory ciphertext) external {
+    function reveal_order(bytes calldata ciphertext) external {
         // check if we are at the reveal phase
         require(phase == Phase.Rev, "This function is not callable at this phase.");
         // only a registered user can commit an order
-        require(us_pk[msg.sender].length > 0, "Transaction address doesn't correspond to a registered user.");
+        require(pks[msg.sender].prefix != 0, "Transaction address doesn't correspond to a registered user.");
+        Order storage order = day_orders[day][msg.sender];
         // check if commitment exists
-        require(orders[msg.sender]._commitment.length > 0, "No commitment was made.");
-        // check if ciphertext exists
-        require(orders[msg.sender]._ciphertext.length == 0, "Ciphertext already revealed.");
-        // add ciphertext
-        orders[msg.sender]._ciphertext = ciphertext;
+        require(order._commitment != 0, "No commitment was made.");
+        // check if ciphertext was already revealed
+        require(!order._revealed, "Ciphertext already revealed.");
+        // check that there is a ciphertext to publish
+        require(ciphertext.length > 0, "Ciphertext must not be empty.");
+        // mark as revealed, the ciphertext itself is only kept in the event log
+        order._revealed = true;
         // emit event
-        emit commitmentRevealed(msg.sender, orders[msg.sender]._commitment, orders[msg.sender]._ciphertext);
+        emit commitmentRevealed(msg.sender, order._commitment, ciphertext);
     }
 
     function claim_fraud() external {
         // check if we are at the reveal phase
         require(phase == Phase.Res, "This function is not callable at this phase.");
         // only a registered user can claim fraud
-        require(us_pk[msg.sender].length > 0, "Transaction address doesn't correspond to a registered user.");
+        require(pks[msg.sender].prefix != 0, "Transaction address doesn't correspond to a registered user.");
         // emit event
         emit fraudClaimed(msg.sender);
     }
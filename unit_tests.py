@@ -6,6 +6,7 @@ from ecies import encrypt, decrypt
 import random
 import hashlib
 from operator import itemgetter
+from helper import missing_functions
 
 # ------------------------------------------------------------------------------
 # Setup
@@ -14,6 +15,12 @@ from operator import itemgetter
 # contract details
 contract_path = './truffle/build/contracts/darkPool.json'
 
+# check that the compiled file matches the contract
+missing = missing_functions(contract_path)
+if missing:
+    sys.exit("Error: {} is out of date ({} missing), run truffle compile"
+             .format(contract_path, ', '.join(missing)))
+
 # open compiled file and get abi & bytecode
 truffleFile = json.load(open(contract_path))
 abi = truffleFile['abi']
@@ -41,6 +48,11 @@ contractAddress = tx_receipt.contractAddress
 # contract interface
 darkPool = w3.eth.contract(address=contractAddress, abi=abi)
 
+# unset bytes32 fields (commitment, secret key) are read as zero bytes
+empty = bytes(32)
+# compressed public key used where any registered key will do
+dummy_pk = b'\x02' + bytes(32)
+
 # create a filter to be notified when we are in a new phase
 # this event contains 2 fields: 'currentState' and 'expirationTime'
 phase_filter = darkPool.events.startPhase.createFilter(fromBlock="latest")
@@ -48,7 +60,7 @@ phase_filter = darkPool.events.startPhase.createFilter(fromBlock="latest")
 # this event contains 3 fields: 'sender', 'commitment' and 'ciphertext'
 order_filter = darkPool.events.commitmentRevealed.createFilter(fromBlock="latest")
 # create a filter to be notified when a secret key is revealed
-# this event contains 4 fields: 'sender', 'commitment', 'ciphertext' and 'secret'
+# this event contains 2 fields: 'sender' and 'secret'
 secret_filter = darkPool.events.secretRevealed.createFilter(fromBlock="latest")
 # create a filter to be notified when a matching is published
 # this event contains 5 fields: 'buyer', 'seller', 'asset', 'amount' and 'price'
@@ -79,16 +91,18 @@ assert darkPool.functions.phase().call() == 0, "Test {} failed: Phase not initia
 test_num += 1
 assert darkPool.functions.operator().call() == w3.eth.accounts[0], "Test 2 failed: Operator not initialised correctly.".format(test_num)
 test_num += 1
+assert darkPool.functions.day().call() == 0, "Test {} failed: Trading day not initialised correctly.".format(test_num)
+test_num += 1
 for i in range(2, clients+4):
     # get address
     addr = w3.eth.accounts[i]
     assert darkPool.functions.us_pk(addr).call() == b'', "Test {} failed: Public-key not initialised correctly.".format(test_num)
     test_num += 1
-    assert darkPool.functions.orders(addr).call()[0] == b'', "Test {} failed: Commitment not initialised correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[0] == empty, "Test {} failed: Commitment not initialised correctly.".format(test_num)
     test_num += 1
-    assert darkPool.functions.orders(addr).call()[1] == b'', "Test {} failed: Ciphertext not initialised correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[1] == False, "Test {} failed: Reveal flag not initialised correctly.".format(test_num)
     test_num += 1
-    assert darkPool.functions.orders(addr).call()[2] == b'', "Test {} failed: Secret-key not initialised correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[2] == empty, "Test {} failed: Secret-key not initialised correctly.".format(test_num)
     test_num += 1
 
 phase_tests = test_num - 1
@@ -104,9 +118,16 @@ except:
     test_num += 1
 else:
     raise Exception("Test {} failed: Non-Operator can register clients.".format(test_num))
+# operator tries to register an uncompressed public key
+try:
+    tx_hash = darkPool.functions.register_client(w3.eth.accounts[2], b'\x04' + bytes(64)).transact()
+except:
+    test_num += 1
+else:
+    raise Exception("Test {} failed: Uncompressed public keys can be registered.".format(test_num))
 # non-operator tries to remove order
 try:
-    tx_hash = darkPool.functions.register_client(w3.eth.accounts[2], b'1').transact()
+    tx_hash = darkPool.functions.register_client(w3.eth.accounts[2], dummy_pk).transact()
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
     tx_hash = darkPool.functions.remove_order(w3.eth.accounts[2]).transact({'from':w3.eth.accounts[1]})
 except:
@@ -117,7 +138,7 @@ else:
     raise Exception("Test {} failed: Non-Operator can remove orders.".format(test_num))
 # non-operator tries to remove client
 try:
-    tx_hash = darkPool.functions.register_client(w3.eth.accounts[2], b'1').transact()
+    tx_hash = darkPool.functions.register_client(w3.eth.accounts[2], dummy_pk).transact()
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
     tx_hash = darkPool.functions.remove_client(w3.eth.accounts[2]).transact({'from':w3.eth.accounts[1]})
 except:
@@ -230,6 +251,13 @@ except:
     test_num += 1
 else:
     raise Exception("Test {} failed: reveal_match can be called at the wrong phase.".format(test_num))
+# reveal_matches -> Cal
+try:
+    tx_hash = darkPool.functions.reveal_matches([('a', w3.eth.accounts[0], b'1', 'b', w3.eth.accounts[1], b'2', 's', 1, 1)]).transact()
+except:
+    test_num += 1
+else:
+    raise Exception("Test {} failed: reveal_matches can be called at the wrong phase.".format(test_num))
 # commit_order -> Trd
 try:
     tx_hash = darkPool.functions.commit_order(b'1').transact()
@@ -367,6 +395,14 @@ for i in range(2, clients+3):
     else:
         raise Exception("Test {} failed: Client can commit multiple times.".format(test_num))
 
+    # try to change to an empty commitment
+    try:
+        tx_hash = darkPool.functions.change_order(empty).transact({'from':addr})
+    except:
+        test_num += 1
+    else:
+        raise Exception("Test {} failed: Client can send an empty commitment.".format(test_num))
+
     # make a different commitment and change the one on the contract
     order_string = "{},{},{},{},{},{}".format('s','b',i+1,11+i,21+i,222*i)
     # encode order string
@@ -392,7 +428,7 @@ for i in range(2, clients+3):
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
     #print("Cancel commitment gas used:", tx_receipt.gasUsed)
     # check if the commitment text on the contract matches the one send
-    assert darkPool.functions.orders(addr).call()[0] == b'', "Test {} failed: Commitment was not deleted.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[0] == empty, "Test {} failed: Commitment was not deleted.".format(test_num)
     test_num += 1
 
     # try to cancel again
@@ -420,7 +456,7 @@ for i in range(2, clients+3):
     test_num += 1
 
 # check that the commitment is empty for a client who didn't send commitmnet
-assert darkPool.functions.orders(w3.eth.accounts[1]).call()[0] == b'', "Test {} failed: Commitment should be empty.".format(test_num)
+assert darkPool.functions.orders(w3.eth.accounts[1]).call()[0] == empty, "Test {} failed: Commitment should be empty.".format(test_num)
 test_num += 1
 
 # not registered tries to commit order
@@ -557,8 +593,8 @@ for i in range(2, clients+2):
     tx_hash = darkPool.functions.reveal_order(ciphertext).transact({'from':addr})
     # wait for the transaction to be mined
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
-    # check if the ciphertext on the contract matches the one send
-    assert darkPool.functions.orders(addr).call()[1] == ciphertext, "Test {} failed: Ciphertext received is incorrect.".format(test_num)
+    # check that the order is marked as revealed, the ciphertext is only in the event
+    assert darkPool.functions.orders(addr).call()[1] == True, "Test {} failed: Order not marked as revealed.".format(test_num)
     test_num += 1
 
     # try to reveal again
@@ -584,8 +620,8 @@ for i in range(2, clients+2):
     assert recCiphertext == ciphertext, "Test {} failed: Reported ciphertext is incorrect".format(test_num)
     test_num += 1
 
-# check that the ciphertext is empty for a client who didn't send ciphertext
-assert darkPool.functions.orders(w3.eth.accounts[1]).call()[1] == b'', "Test {} failed: Ciphertext should be empty.".format(test_num)
+# check that the order isn't revealed for a client who didn't send ciphertext
+assert darkPool.functions.orders(w3.eth.accounts[1]).call()[1] == False, "Test {} failed: Order should not be revealed.".format(test_num)
 test_num += 1
 
 # not registered tries to reveal order
@@ -595,6 +631,13 @@ except:
     test_num += 1
 else:
     raise Exception("Test {} failed: Not registered client can reveal order.".format(test_num))
+# registered client that committed tries to reveal an empty ciphertext
+try:
+    tx_hash = darkPool.functions.reveal_order(b'').transact({'from':w3.eth.accounts[clients+2]})
+except:
+    test_num += 1
+else:
+    raise Exception("Test {} failed: Client can reveal an empty ciphertext.".format(test_num))
 # registered client that didn't commit tries to reveal order
 try:
     tx_hash = darkPool.functions.reveal_order(b'1').transact(w3.eth.accounts[clients+3])
@@ -721,18 +764,29 @@ event = match_filter.get_new_entries()
 assert len(event) == 0, "Test {} failed: Match event emitted incorrectly.".format(test_num)
 test_num += 1
 
-# read commitments and ciphertext for each client
+# read commitments for each client, ciphertexts are read from the event logs
+logs = darkPool.events.commitmentRevealed.getLogs(fromBlock=0)
+revealed = {e['args']['sender']: e['args']['ciphertext'] for e in logs}
 for i in range(2, clients+2):
     # get address
     addr = w3.eth.accounts[i]
     # get order from contract
     order = darkPool.functions.orders(addr).call()
     commitment = order[0]
-    ciphertext = order[1]
+    ciphertext = revealed[addr]
     # check if ciphertext matches commitment
     assert commitment == hashlib.sha3_256(ciphertext).digest(), "Test {} failed: Received commitment doesn't match with received ciphertext.".format(test_num)
     test_num += 1
 
+# read all orders at once, they must be the same as the ones read one by one
+addrs = [w3.eth.accounts[i] for i in range(2, clients+2)]
+bulk = darkPool.functions.get_orders(addrs).call()
+assert len(bulk) == clients, "Test {} failed: Wrong number of orders read.".format(test_num)
+test_num += 1
+for addr, order in zip(addrs, bulk):
+    assert tuple(order) == tuple(darkPool.functions.orders(addr).call()), "Test {} failed: Order read in bulk is incorrect.".format(test_num)
+    test_num += 1
+
 # try seller == buyer
 try:
     tx_hash = darkPool.functions.reveal_match(w3.eth.accounts[2], b'1', '1', w3.eth.accounts[2], b'2', '2', 1, 1).transact()
@@ -768,6 +822,14 @@ except:
     test_num += 1
 else:
     raise Exception("Test {} failed: Buyer in match didn't commit.".format(test_num))
+# empty secret key for a client whose key wasn't published yet
+try:
+    tx_hash = darkPool.functions.reveal_match('a', w3.eth.accounts[2], empty, '2', w3.eth.accounts[3],
+                        addr2keys[w3.eth.accounts[3]].secret, '3', 1, 1).transact()
+except:
+    test_num += 1
+else:
+    raise Exception("Test {} failed: Secret key of a match can be left out before it is published.".format(test_num))
 
 for i in range(2, clients+1):
     b = w3.eth.accounts[i]
@@ -789,16 +851,10 @@ for i in range(2, clients+1):
     assert len(events) == 2, "Test {} failed: Contract should emit 2 secretRevealed events.".format(test_num)
     test_num += 1
     for e in events:
-        # check that client, commitment, ciphertext and secret key on event are correct
+        # check that client and secret key on event are correct
         sender = e['args']['sender']
         assert sender == b or sender == s, "Test {} failed: Reported sender is incorrect".format(test_num)
         test_num += 1
-        commitment = e['args']['commitment']
-        assert commitment == hashlib.sha3_256(ciphertexts[sender]).digest(), "Test {} failed: Reported commitment is incorrect".format(test_num)
-        test_num += 1
-        recCiphertext = e['args']['ciphertext']
-        assert recCiphertext == ciphertexts[sender], "Test {} failed: Reported ciphertext is incorrect".format(test_num)
-        test_num += 1
         secret = e['args']['secret']
         assert secret == bSK or secret == sSK, "Test {} failed: Reported secret key is incorrect".format(test_num)
         test_num += 1
@@ -824,8 +880,64 @@ for i in range(2, clients+1):
     assert price == 100*i, "Test {} failed: Reported price is incorrect".format(test_num)
     test_num += 1
 
+# trades are filtered by the node on their indexed buyer, seller and asset
+logs = darkPool.events.logTrade.getLogs(fromBlock=0, argument_filters={'buyerAddr': w3.eth.accounts[2]})
+assert len(logs) == 1 and logs[0]['args']['buyerAddr'] == w3.eth.accounts[2], "Test {} failed: Trades filtered by buyer are incorrect.".format(test_num)
+test_num += 1
+logs = darkPool.events.logTrade.getLogs(fromBlock=0, argument_filters={'sellerAddr': w3.eth.accounts[clients+1]})
+assert len(logs) == 1 and logs[0]['args']['sellerAddr'] == w3.eth.accounts[clients+1], "Test {} failed: Trades filtered by seller are incorrect.".format(test_num)
+test_num += 1
+logs = darkPool.events.logTrade.getLogs(fromBlock=0, argument_filters={'assetId': Web3.keccak(text='a')})
+assert len(logs) == clients-1, "Test {} failed: Trades filtered by asset are incorrect.".format(test_num)
+test_num += 1
+logs = darkPool.events.logTrade.getLogs(fromBlock=0, argument_filters={'assetId': Web3.keccak(text='b')})
+assert len(logs) == 0, "Test {} failed: Trades of another asset returned.".format(test_num)
+test_num += 1
+logs = darkPool.events.secretRevealed.getLogs(fromBlock=0, argument_filters={'sender': w3.eth.accounts[2]})
+assert len(logs) == 1 and logs[0]['args']['sender'] == w3.eth.accounts[2], "Test {} failed: Secrets filtered by sender are incorrect.".format(test_num)
+test_num += 1
+
+# a batch with an invalid trade is rejected as a whole
+try:
+    tx_hash = darkPool.functions.reveal_matches([
+        ('a', w3.eth.accounts[2], b'1', '2', w3.eth.accounts[3], b'2', '3', 1, 1),
+        ('a', w3.eth.accounts[2], b'1', '2', w3.eth.accounts[2], b'2', '2', 1, 1)]).transact()
+except:
+    test_num += 1
+else:
+    raise Exception("Test {} failed: Batch with Seller=Buyer in revealed match.".format(test_num))
+event = match_filter.get_new_entries()
+assert len(event) == 0, "Test {} failed: Match event emitted incorrectly.".format(test_num)
+test_num += 1
+
+# operator publishes more matches of the same clients in one transaction,
+# their secret keys were already published so empty ones are sent
+trades = []
+for i in range(2, clients+1):
+    b = w3.eth.accounts[i]
+    s = w3.eth.accounts[i+1]
+    trades.append(('a', b, empty, str(i), s, empty, str(i+1), i, 10*i))
+tx_hash = darkPool.functions.reveal_matches(trades).transact()
+tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+# the published secret keys are kept
+for i in range(2, clients+2):
+    addr = w3.eth.accounts[i]
+    assert darkPool.functions.orders(addr).call()[2] == addr2keys[addr].secret, "Test {} failed: Published secret key was overwritten.".format(test_num)
+    test_num += 1
+# secret keys were already published, no secretRevealed event is emitted
+events = secret_filter.get_new_entries()
+assert len(events) == 0, "Test {} failed: Contract should not emit secretRevealed events.".format(test_num)
+test_num += 1
+# one logTrade event per trade, in order
+events = match_filter.get_new_entries()
+assert len(events) == len(trades), "Test {} failed: Contract should emit {} logTrade events.".format(test_num, len(trades))
+test_num += 1
+for trade, e in zip(trades, events):
+    assert (e['args']['buyer'], e['args']['seller'], e['args']['amount'], e['args']['price']) == (trade[3], trade[6], trade[7], trade[8]), "Test {} failed: Reported trade is incorrect".format(test_num)
+    test_num += 1
+
 # check that the secret key is empty for a client who didn't participate
-assert darkPool.functions.orders(w3.eth.accounts[1]).call()[2] == b'', "Test {} failed: Commitment should be empty.".format(test_num)
+assert darkPool.functions.orders(w3.eth.accounts[1]).call()[2] == empty, "Test {} failed: Commitment should be empty.".format(test_num)
 test_num += 1
 
 #check that we can't call functions that need a different phase
@@ -1042,11 +1154,18 @@ phase_tests = test_num - 1
 # ----- Second Registration Phase Tests: -----
 
 # change phase
+day = darkPool.functions.day().call()
 tx_hash = darkPool.functions.reg_phase().transact()
 # wait for the transaction to be mined
 tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
 assert darkPool.functions.phase().call() == 0, "Test {} failed: Registration Phase not initialised correctly.".format(test_num)
 test_num += 1
+# a new trading day starts with no orders
+assert darkPool.functions.day().call() == day + 1, "Test {} failed: Trading day not incremented.".format(test_num)
+test_num += 1
+for order in darkPool.functions.get_orders([w3.eth.accounts[i] for i in range(2, clients+4)]).call():
+    assert tuple(order) == (empty, False, empty), "Test {} failed: Orders of the previous day are still present.".format(test_num)
+    test_num += 1
 
 # get phase event
 event = phase_filter.get_new_entries()
@@ -1081,11 +1200,11 @@ for i in range(2, clients+4):
     # wait for the transaction to be mined
     tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
     #print("Remove order gas used:", tx_receipt.gasUsed)
-    assert darkPool.functions.orders(addr).call()[0] == b'', "Test {} failed: Commitment not reset correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[0] == empty, "Test {} failed: Commitment not reset correctly.".format(test_num)
     test_num += 1
-    assert darkPool.functions.orders(addr).call()[1] == b'', "Test {} failed: Ciphertext not reset correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[1] == False, "Test {} failed: Reveal flag not reset correctly.".format(test_num)
     test_num += 1
-    assert darkPool.functions.orders(addr).call()[2] == b'', "Test {} failed: Secret-key not reset correctly.".format(test_num)
+    assert darkPool.functions.orders(addr).call()[2] == empty, "Test {} failed: Secret-key not reset correctly.".format(test_num)
     test_num += 1
 
     # remove client
@@ -1,5 +1,9 @@
 import os
 from flask import Flask, render_template, redirect, url_for, request
+from helper import Order, encode_order
+
+assets = ['g','t','f'] # list of tradable assets
+binary = True # save orders in the compact binary format
 
 registered = []
 file_name = './data/registered.dat'
@@ -61,10 +65,18 @@ def client(id):
 
         # save order
         order_string = "{},{},{},{},{}".format(type, asset, price, volume, mes)
+        order_bytes = order_string.encode('utf-8')
+        if binary:
+            try:
+                order = Order(id, type, asset, int(price), int(volume), int(mes), '')
+                order_bytes = encode_order(order, assets)
+            except Exception:
+                # can't be encoded, keep the order string (operator rejects it)
+                pass
         file_name = './data/client_order_'+id+'.dat'
 
-        f=open(file_name, 'w')
-        f.write(order_string)
+        f=open(file_name, 'wb')
+        f.write(order_bytes)
         f.close()
 
     return render_template('client.html')